@@ -0,0 +1,103 @@
+"""Banknote backend comparison
+
+Compares the accuracy and speed of the banknote model run by different
+inference backends (see `KerasCnnImageService`) on the test data: the Keras
+model, its TFLite conversions without quantization, with float16 and with
+int8 quantization, and its ONNX export.
+
+Every backend uses the banknote configuration (including the background
+threshold) with only the backend options replaced. For each backend, the
+script prints the percentage of correct, incorrect and background predictions,
+the percentage of predictions that agree with the Keras model and the average
+inference time per image.
+
+This script accepts the names of the backends to compare as args (default: all
+of them), among: keras, tflite, tflite-float16, tflite-int8, onnx.
+"""
+
+__author__ = "Omar Othman <omar.othman@live.com>"
+
+
+import os
+import sys
+import time
+
+from torchapi import get_config
+from torchapi.services.banknote import BanknoteService
+
+from .util import load_base64, TEST_DIR
+
+
+BACKENDS = {
+    "keras": {"backend": "keras"},
+    "tflite": {"backend": "tflite"},
+    "tflite-float16": {"backend": "tflite", "quantization": "float16"},
+    "tflite-int8": {"backend": "tflite", "quantization": "int8"},
+    "onnx": {"backend": "onnx"},
+}
+
+BATCH_SIZE = 32
+
+
+def main():
+    names = sys.argv[1:] or list(BACKENDS)
+    for name in names:
+        if name not in BACKENDS:
+            print(f"Unknown backend: {name}")
+            sys.exit(1)
+
+    # get all directories (classes) in the test directory
+    (dirpath, dirnames, _) = next(os.walk(TEST_DIR))
+    images = []
+    for dirname in dirnames:
+        images += load_base64(dirname, os.path.join(dirpath, dirname),
+                              desc=f"Loading class {dirname}")
+
+    keras_predictions = None
+    for name in names:
+        config = dict(get_config("banknote") or {})
+        config.pop("quantization", None)
+        config.update(BACKENDS[name])
+        service = BanknoteService(config)
+        # the first run sets up the inference; it is not part of the timing
+        service.warmup()
+
+        predictions = []
+        elapsed = 0
+        for start in range(0, len(images), BATCH_SIZE):
+            reqs = [{"image": image}
+                    for (image, _) in images[start:start + BATCH_SIZE]]
+            begin = time.perf_counter()
+            results = service.predict_batch(reqs)
+            elapsed += time.perf_counter() - begin
+            predictions += [result if isinstance(result, Exception)
+                            else result[0] for result in results]
+        if name == "keras":
+            keras_predictions = predictions
+
+        correct = incorrect = background = error = 0
+        for prediction, (_, class_name) in zip(predictions, images):
+            if isinstance(prediction, Exception):
+                error += 1
+            elif prediction == class_name:
+                correct += 1
+            elif prediction == "bg":
+                background += 1
+            else:
+                incorrect += 1
+
+        print(f"\n[{name}]")
+        print(f"Correct: {correct / len(images) * 100:.2f}%")
+        print(f"Incorrect: {incorrect / len(images) * 100:.2f}%")
+        print(f"Background: {background / len(images) * 100:.2f}%")
+        print(f"Error: {error / len(images) * 100:.2f}%")
+        if keras_predictions is not None and name != "keras":
+            agreement = sum(1 for prediction, keras_prediction
+                            in zip(predictions, keras_predictions)
+                            if prediction == keras_prediction)
+            print(f"Agreement with keras: {agreement / len(images) * 100:.2f}%")
+        print(f"Time per image: {elapsed / len(images) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
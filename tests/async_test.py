@@ -0,0 +1,69 @@
+"""Torch API asynchronous request test
+
+Emulation of an asynchronous server sending concurrent requests to the API.
+"""
+
+
+import asyncio
+import datetime
+import json
+import os
+
+from torchapi import handle_async
+
+
+def main():
+    """Emulates an asynchronous server sending concurrent requests to the API:
+    every banknote test image twice (the second time answered from the result
+    cache), a detailed color request with different options and a request for
+    an unknown service.
+    """
+
+    (dirpath, dirnames, _) = next(
+        os.walk(os.path.join(os.path.dirname(__file__), "test_input")))
+
+    requests = []
+    actual_classes = []
+    for dirname in dirnames:
+        if dirname in ['5', '10', '20', '50', 'bg']:
+            full_path = os.path.join(dirpath, dirname)
+            (_, _, filenames) = next(os.walk(full_path))
+            for filename in filenames:
+                with open(os.path.join(full_path, filename), "r") as base64_file:
+                    image_base64 = base64_file.read()
+                requests.append({"request": "banknote", "image": image_base64})
+                actual_classes.append(dirname)
+
+    image_base64 = requests[0]["image"]
+    extra_requests = [
+        ("detailed color", {"request": "detailed_color", "image": image_base64}),
+        ("3 detailed colors", {"request": "detailed_color",
+                               "image": image_base64, "colors": 3}),
+        ("error", {"request": "unknown"}),
+    ]
+
+    for round_name in ["first", "second"]:
+        print(f"{str(datetime.datetime.now())} - Sending {len(requests)} "
+              f"concurrent banknote requests ({round_name} time)")
+        responses = asyncio.run(_send_all(requests))
+        print(f"{str(datetime.datetime.now())} - Received all responses")
+        for actual_class, response in zip(actual_classes, responses):
+            print(f"Actual class {actual_class} - response = {response}")
+
+    print(f"{str(datetime.datetime.now())} - Sending {len(extra_requests)} "
+          "concurrent requests")
+    responses = asyncio.run(_send_all(
+        [request for _, request in extra_requests]))
+    for (description, _), response in zip(extra_requests, responses):
+        print(f"Request {description} - response = {response}")
+
+
+async def _send_all(requests: list) -> list:
+    """Sends all the given requests at once and returns their responses in the
+    same order."""
+    return await asyncio.gather(*[handle_async(json.dumps(request))
+                                  for request in requests])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Torch API batch request test
+
+Emulation of a server sending a batch of requests to the API.
+"""
+
+
+import datetime
+import json
+import os
+
+from torchapi import handle_batch
+
+
+def main():
+    """Emulates a server sending a batch of mixed requests to the API.
+    """
+
+    (dirpath, dirnames, _) = next(
+        os.walk(os.path.join(os.path.dirname(__file__), "test_input")))
+
+    # Collect all banknote test images into a single batch
+    requests = []
+    actual_classes = []
+    for dirname in dirnames:
+        if dirname in ['5', '10', '20', '50', 'bg']:
+            full_path = os.path.join(dirpath, dirname)
+            (_, _, filenames) = next(os.walk(full_path))
+            for filename in filenames:
+                with open(os.path.join(full_path, filename), "r") as base64_file:
+                    image_base64 = base64_file.read()
+                requests.append({"request": "banknote", "image": image_base64})
+                actual_classes.append(dirname)
+
+    # Mix in an unknown service to check that responses keep their order
+    requests.append({"request": "unknown"})
+    actual_classes.append("error")
+
+    print(
+        f"{str(datetime.datetime.now())} - Sending batch of {len(requests)} requests")
+    responses = json.loads(handle_batch(json.dumps(requests)))
+    for actual_class, response in zip(actual_classes, responses):
+        print(f"Actual class {actual_class} - response = {response}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Torch API cache test
+
+Emulation of a server sending repeated requests to a service behind its result
+cache, near-duplicate cache and micro-batching scheduler.
+"""
+
+
+import base64
+import datetime
+import io
+import os
+import threading
+
+from PIL import Image
+
+from torchapi.cache import CachedPredictor, NearDuplicateCache, ResultCache
+from torchapi.scheduler import MicroBatcher
+from torchapi.services.detailed_color import DetailedColor
+from torchapi.util import get_config
+
+
+class CountingService:
+    """Passes batches to the given `service`, counting the requests that reach
+    it (i.e. that are not answered from a cache) and the batches they come in.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.service_name = service.service_name
+        self.requests = 0
+        self.batch_sizes = []
+        self._lock = threading.Lock()
+
+    def predict_batch(self, reqs: list) -> list:
+        with self._lock:
+            self.requests += len(reqs)
+            self.batch_sizes.append(len(reqs))
+        return self.service.predict_batch(reqs)
+
+
+def main():
+    """Emulates a server sending the same images, re-encoded copies of them and
+    requests with different options to a cached and micro-batched service.
+    """
+
+    test_input_path = os.path.join(os.path.dirname(__file__), "test_input")
+    images = []
+    for dirname in ['5', '10', '20', '50', 'bg']:
+        full_path = os.path.join(test_input_path, dirname)
+        for filename in sorted(os.listdir(full_path)):
+            with open(os.path.join(full_path, filename), "r") as base64_file:
+                images.append((f"{dirname}/{filename}", base64_file.read()))
+
+    service = CountingService(
+        DetailedColor(config=get_config("detailed_color")))
+    batcher = MicroBatcher(service, max_batch=8, max_wait=0.05)
+    predictor = CachedPredictor(
+        service.service_name, batcher, cache=ResultCache(max_size=64, ttl=60),
+        near_cache=NearDuplicateCache(max_distance=4, max_size=64, ttl=60))
+
+    name, image = images[0]
+    requests = [
+        (f"{name}", {"image": image}),
+        (f"{name} again", {"image": image}),
+        (f"{name} re-encoded", {"image": _reencode(image)}),
+        (f"{name} with 3 colors", {"image": image, "colors": 3}),
+        (f"{name} with 3 colors again", {"image": image, "colors": 3}),
+        (f"{images[1][0]}", {"image": images[1][1]}),
+        ("invalid image", {"image": "not an image"}),
+    ]
+    for description, request in requests:
+        before = service.requests
+        print(f"{str(datetime.datetime.now())} - Sending {description}")
+        try:
+            response = predictor.predict(request)
+        except Exception as exception:
+            response = f"error: {exception}"
+        status = "miss" if service.requests > before else "hit"
+        print(f"Cache {status} - response = {response}")
+
+    # Concurrent requests are run together; images seen above are answered
+    # from the caches
+    print(f"\n{str(datetime.datetime.now())} - Sending {len(images)} requests "
+          "from concurrent threads")
+    service.batch_sizes = []
+    responses = [None] * len(images)
+
+    def send(index):
+        responses[index] = predictor.predict({"image": images[index][1]})
+
+    threads = [threading.Thread(target=send, args=(index,))
+               for index in range(len(images))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for (name, _), response in zip(images, responses):
+        print(f"Image {name} - response = {response}")
+    print(f"Batches run by the service: {service.batch_sizes}")
+
+
+def _reencode(image_base64: str) -> str:
+    """Returns the given base-64 image re-encoded as a JPEG, which changes its
+    bytes but not what it looks like."""
+    data = base64.b64decode(image_base64.split(",", 1)[-1])
+    output = io.BytesIO()
+    Image.open(io.BytesIO(data)).convert("RGB").save(
+        output, "JPEG", quality=90)
+    return ("data:image/jpeg;base64," +
+            base64.b64encode(output.getvalue()).decode("ascii"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Torch API fork test
+
+Emulation of the pre-forked server (`torchapi.serve`): services are loaded in
+this process, which then forks a worker that runs them first. Run this module
+on its own (`python -m tests modules fork_test`), so that no model has run in
+this process before forking.
+"""
+
+
+import datetime
+import json
+import os
+import signal
+
+from torchapi import handle
+from torchapi.api import is_fork_safe, load_services
+
+# seconds after which a worker that does not answer is considered hung
+WORKER_TIMEOUT = 120
+
+
+def main():
+    """Loads the services without running them, forks a worker that sends
+    requests to them, then sends the same requests in this process and compares
+    the responses.
+    """
+
+    test_input_path = os.path.join(os.path.dirname(__file__), "test_input")
+    requests = []
+    for dirname in ['5', '10', '20', '50', 'bg']:
+        full_path = os.path.join(test_input_path, dirname)
+        for filename in sorted(os.listdir(full_path)):
+            with open(os.path.join(full_path, filename), "r") as base64_file:
+                image_base64 = base64_file.read()
+            requests.append({"request": "banknote", "image": image_base64})
+            requests.append({"request": "detailed_color",
+                             "image": image_base64})
+
+    for name in sorted({request["request"] for request in requests}):
+        load_services([name])
+        print(f"Loaded {name} (fork-safe: {is_fork_safe(name)})")
+
+    print(f"{str(datetime.datetime.now())} - Sending {len(requests)} requests "
+          "from a forked worker")
+    worker_responses, status = _run_in_worker(requests)
+    if worker_responses is None:
+        print(f"Worker failed or hung (exit status {status})")
+        return
+
+    print(f"{str(datetime.datetime.now())} - Sending the same requests from "
+          "this process")
+    for request, worker_response in zip(requests, worker_responses):
+        response = json.loads(handle(json.dumps(request)))
+        same = _without_time(response) == _without_time(worker_response)
+        print(f"Service {request['request']} - worker response = "
+              f"{worker_response} - same as here: {same}")
+
+
+def _run_in_worker(requests: list) -> (list, int):
+    """Sends the given requests from a forked worker and returns their
+    responses (`None` if the worker failed) and the exit status of the worker.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # worker
+        os.close(read_fd)
+        try:
+            signal.alarm(WORKER_TIMEOUT)
+            responses = [json.loads(handle(json.dumps(request)))
+                         for request in requests]
+            with os.fdopen(write_fd, "w") as pipe:
+                json.dump(responses, pipe)
+        except BaseException as err:
+            print(f"Worker error: {err}")
+            os._exit(1)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "r") as pipe:
+        output = pipe.read()
+    _, status = os.waitpid(pid, 0)
+    return (json.loads(output) if output else None), status
+
+
+def _without_time(response: dict) -> dict:
+    return {key: value for key, value in response.items() if key != "time"}
+
+
+if __name__ == "__main__":
+    main()
@@ -26,25 +26,29 @@ def main():
     test_files = os.listdir(object_detection_test_input_path)
 
     for im in test_files:
-        # Emulate the api call
-        request = {}
-        request["request"] = "object_detection"
-
         # Read the current_test_file and convert to base64
         with open(os.path.join(object_detection_test_input_path, im) , 'rb') as image_file:
             encoded_string = base64.b64encode(
                 image_file.read())
-        request["image"] = "data:image/png;base64," + \
-            encoded_string.decode('utf-8')
-        request_json = json.dumps(request)
 
-        print(
-            f"{str(datetime.datetime.now())} - Sending request (Object Detection)")
+        # Emulate the api call in every response format: the default
+        # (sentence), structured and an invalid one (error)
+        for response_format in [None, "structured", "invalid"]:
+            request = {}
+            request["request"] = "object_detection"
+            request["image"] = "data:image/png;base64," + \
+                encoded_string.decode('utf-8')
+            if response_format is not None:
+                request["format"] = response_format
+            request_json = json.dumps(request)
+
+            print(
+                f"{str(datetime.datetime.now())} - Sending request (Object Detection, format {response_format or 'sentence'})")
 
-        response = handle(request_json)
-        response_dict = json.loads(response)
+            response = handle(request_json)
+            response_dict = json.loads(response)
 
-        print(f"{response_dict}")
+            print(f"{response_dict}")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,3 @@
 # expose these functions directly to allow "from torchapi import x"
-from .api import handle
+from .api import handle, handle_async, handle_batch, warmup
 from .util import error_response, get_config
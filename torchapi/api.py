@@ -7,26 +7,138 @@ documentation.
 __author__ = "Omar Othman"
 
 
+import asyncio
 import json
+import threading
 
+from .cache import CachedPredictor, create_cache, create_near_duplicate_cache
 from .exceptions import TorchException
-from .services.banknote import BanknoteService
-from .services.color_detection import ColorDetectionService
-from .services.detailed_color import DetailedColor
-from .services.ocr import OcrService
-from .services.object_detection import ObjectDetectionService
+from .executor import get_executor
+from .logger import log_e
+from .scheduler import create_batcher
 from .util import error_response, get_config, response_builder
 
-# service instances defined here should live as long as the session
-_SERVICES = {
-    "banknote": BanknoteService(config=get_config("banknote")),
-    "ocr": OcrService(),
-    "color": ColorDetectionService(ObjectDetectionService()),
-    "detailed_color": DetailedColor(),
-    "object_detection": ObjectDetectionService()
+
+# Service modules are imported inside their factories so that importing the
+# API does not import TensorFlow, OpenCV, etc. or load any model until a
+# service is actually used.
+
+def _create_banknote():
+    from .services.banknote import BanknoteService
+    return BanknoteService(config=get_config("banknote"))
+
+
+def _create_ocr():
+    from .services.ocr import OcrService
+    return OcrService()
+
+
+def _create_color():
+    from .services.color_detection import ColorDetectionService
+    # share the object detection model with the object_detection service
+    return ColorDetectionService(_get_service("object_detection"),
+                                 config=get_config("color"))
+
+
+def _create_detailed_color():
+    from .services.detailed_color import DetailedColor
+    return DetailedColor(config=get_config("detailed_color"))
+
+
+def _create_object_detection():
+    from .services.object_detection import ObjectDetectionService
+    return ObjectDetectionService(config=get_config("object_detection"))
+
+
+_SERVICE_FACTORIES = {
+    "banknote": _create_banknote,
+    "ocr": _create_ocr,
+    "color": _create_color,
+    "detailed_color": _create_detailed_color,
+    "object_detection": _create_object_detection
 }
 
+# service instances are created on first use and should live as long as the
+# session
+_SERVICES = {}
+
+# the objects requests are passed to, per service: the service itself, wrapped
+# in its micro-batching scheduler (concurrent requests are run together in a
+# single batch) and its result cache, if enabled
+_PREDICTORS = {}
+
+# reentrant because creating a service may create the services it depends on
+_SERVICES_LOCK = threading.RLock()
+
+_TAG = "api"
+
 _UNKNOWN_SERVICE_ERROR = error_response(origin="server", msg="Unknown service")
+_INVALID_REQUEST_ERROR = error_response(origin="server", msg="Invalid request")
+_INTERNAL_ERROR = error_response(origin="server", msg="Internal error")
+
+# the services whose models run on TensorFlow unless another backend is
+# configured, and the services that other services are created with
+_TENSORFLOW_SERVICES = ("banknote", "object_detection")
+_SERVICE_DEPENDENCIES = {"color": ("object_detection",)}
+
+# the backends whose models keep working in the children of the process that
+# loaded them. Their runtimes start thread pools when a model is loaded, but
+# forked children were checked to run them correctly with ONNX Runtime 1.31 and
+# LiteRT 2.3; check other versions with `tests/fork_test.py`
+_FORK_SAFE_BACKENDS = ("tflite", "onnx")
+
+
+def warmup(services: list = None):
+    """Creates the given `services` (a list of service names), loading their
+    models, and runs each model once, so that the first requests to them do
+    not pay the loading time. If `services` is not given, all services are
+    warmed up.
+
+    Services that are not warmed up are created and warmed up on their first
+    request.
+    """
+    for name in load_services(services):
+        _get_service(name).warmup()
+
+
+def load_services(services: list = None, fork_safe_only: bool = False) -> list:
+    """Creates the given `services` like `warmup` but without running their
+    models, and returns the names of the created services. If `services` is
+    not given, all services are created.
+
+    If `fork_safe_only` is true, only the services that are safe to create
+    before forking (see `is_fork_safe`) are created.
+    """
+    if services is None:
+        services = list(_SERVICE_FACTORIES)
+    unknown = [name for name in services if name not in _SERVICE_FACTORIES]
+    if unknown:
+        raise ValueError(f"Unknown services: {', '.join(unknown)}")
+    if fork_safe_only:
+        services = [name for name in services if is_fork_safe(name)]
+    for name in services:
+        # dependencies first, so that creating the service does not warm them
+        # up
+        for dependency in _SERVICE_DEPENDENCIES.get(name, ()):
+            _get_service(dependency, warm=False)
+        _get_service(name, warm=False)
+    return services
+
+
+def is_fork_safe(name: str) -> bool:
+    """Returns whether the service with the given `name` keeps working in the
+    children of a process that created it (but did not run it) before forking.
+
+    TensorFlow's thread pools do not survive `fork`, so services running on
+    TensorFlow (the default backend of model-backed services) are not. Run
+    `python -m tests modules fork_test` to check the configured services.
+    """
+    config = get_config(name) or {}
+    if name in _TENSORFLOW_SERVICES and \
+            config.get("backend") not in _FORK_SAFE_BACKENDS:
+        return False
+    return all(is_fork_safe(dependency)
+               for dependency in _SERVICE_DEPENDENCIES.get(name, ()))
 
 
 def handle(req: str) -> str:
@@ -38,15 +150,143 @@ def handle(req: str) -> str:
     returned.
     """
     jsonstr = json.loads(req)
-    service = _SERVICES.get(jsonstr["request"])
+    service = _get_predictor(jsonstr["request"])
+    if not service:
+        response = _UNKNOWN_SERVICE_ERROR
+    else:
+        try:
+            response = _build_response(service.predict(jsonstr))
+        except TorchException as exception:
+            response = _build_response(exception)
+    return json.dumps(response)
+
+
+async def handle_async(req: str) -> str:
+    """Coroutine version of `handle`, for use in asynchronous servers.
+
+    Inference runs on a bounded executor owned by the API, so awaiting this
+    does not block the event loop and concurrent requests do not oversubscribe
+    the CPU.
+    """
+    jsonstr = json.loads(req)
+    name = jsonstr["request"]
+    if name in _SERVICE_FACTORIES and name not in _SERVICES:
+        # creating a service loads its model; keep that off the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(get_executor(), _get_service, name)
+    service = _get_predictor(name)
     if not service:
         response = _UNKNOWN_SERVICE_ERROR
     else:
         try:
-            prediction, confidence = service.predict(jsonstr)
-            response = response_builder(
-                response=prediction, confidence=confidence)
+            response = _build_response(await service.predict_async(jsonstr))
         except TorchException as exception:
-            response = error_response(
-                origin=exception.origin, msg=str(exception))
+            response = _build_response(exception)
     return json.dumps(response)
+
+
+def handle_batch(req: str) -> str:
+    """Accepts a JSON array of requests (string), each conforming to the
+    specification defined in the Torch API documentation, and returns a JSON
+    array of responses (string) in the same order.
+
+    Requests may target different services. Requests for the same service are
+    grouped and passed to that service together, so that model-backed services
+    run a single forward pass per group (or per `max_batch` requests, if
+    micro-batching is enabled) instead of one per image.
+
+    A request that fails (including one that is not a JSON object) gets an
+    error response in its own slot; the other requests are not affected.
+    """
+    jsonstrs = json.loads(req)
+    if not isinstance(jsonstrs, list):
+        raise ValueError("A batch of requests must be a JSON array")
+    responses = [None] * len(jsonstrs)
+    # indexes of the requests of each service, in order of appearance
+    groups = {}
+    for index, jsonstr in enumerate(jsonstrs):
+        if not isinstance(jsonstr, dict):
+            responses[index] = _INVALID_REQUEST_ERROR
+            continue
+        name = jsonstr.get("request")
+        if not isinstance(name, str) or name not in _SERVICE_FACTORIES:
+            responses[index] = _UNKNOWN_SERVICE_ERROR
+        else:
+            groups.setdefault(name, []).append(index)
+    for name, indexes in groups.items():
+        reqs = [jsonstrs[index] for index in indexes]
+        try:
+            results = _get_predictor(name).predict_batch(reqs)
+        except Exception as err:
+            # run the requests one by one so that only the failing ones get
+            # an error
+            log_e(_TAG, f"Batch of {name} failed: {err!r}")
+            results = [_predict_single(name, req) for req in reqs]
+        for index, result in zip(indexes, results):
+            responses[index] = _build_response(result)
+    return json.dumps(responses)
+
+
+def _predict_single(name: str, req: dict):
+    """Returns the result of the given `req`uest for the service with the given
+    `name`, or the exception it raised."""
+    try:
+        return _get_predictor(name).predict_batch([req])[0]
+    except Exception as err:
+        log_e(_TAG, f"Request of {name} failed: {err!r}")
+        return err
+
+
+def _get_service(name: str, warm: bool = True):
+    """Returns the service with the given `name`, creating it if it is not
+    created yet. Returns `None` if the service does not exist.
+
+    A service created here is warmed up before it is returned, unless `warm`
+    is false.
+    """
+    service = _SERVICES.get(name)
+    if service is None and name in _SERVICE_FACTORIES:
+        with _SERVICES_LOCK:
+            service = _SERVICES.get(name)
+            if service is None:
+                service = _SERVICE_FACTORIES[name]()
+                if warm:
+                    service.warmup()
+                _PREDICTORS[name] = _create_predictor(service, get_config(name))
+                # published last, so that a service is never visible without
+                # its predictor
+                _SERVICES[name] = service
+    return service
+
+
+def _create_predictor(service, config: dict):
+    predictor = create_batcher(service, config) or service
+    cache = create_cache(config)
+    near_cache = create_near_duplicate_cache(config)
+    if cache or near_cache:
+        predictor = CachedPredictor(service.service_name, predictor,
+                                    cache=cache, near_cache=near_cache)
+    return predictor
+
+
+def _get_predictor(name: str):
+    """Returns the object that requests for the service with the given `name`
+    are passed to (see `_PREDICTORS`). Returns `None` if the service does not
+    exist.
+    """
+    if _get_service(name) is None:
+        return None
+    return _PREDICTORS[name]
+
+
+def _build_response(result) -> dict:
+    """Builds the response for a single `result` of a service, which is either
+    a `(prediction, confidence)` tuple or an exception (a `TorchException` for
+    request errors).
+    """
+    if isinstance(result, TorchException):
+        return error_response(origin=result.origin, msg=str(result))
+    if isinstance(result, Exception):
+        return _INTERNAL_ERROR
+    prediction, confidence = result
+    return response_builder(response=prediction, confidence=confidence)
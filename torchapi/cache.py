@@ -0,0 +1,227 @@
+"""Torch result cache
+
+Caches service results so that repeated requests for the same (or a nearly
+identical) image are not run through the models again.
+"""
+
+__author__ = "Omar Othman"
+
+
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .executor import get_decode_executor
+
+
+class ResultCache:
+    """A thread-safe cache of at most `max_size` entries, evicting the least
+    recently used entry when full. Entries older than `ttl` seconds are
+    considered expired. If `ttl` is `None`, entries never expire.
+    """
+
+    def __init__(self, max_size: int, ttl: float = None):
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1")
+        if ttl is not None and ttl <= 0:
+            raise ValueError("Cache TTL must be positive")
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expiry time, value), in order of use
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value cached for the given `key`, or `None` if there is
+        no such value or it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expiry, value = entry
+            if expiry is not None and expiry <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Caches the given `value` for the given `key`."""
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def recent_keys(self) -> list:
+        """Returns the keys of all entries, most recently used first. Expired
+        entries may be included."""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class NearDuplicateCache:
+    """A thread-safe cache of at most `max_size` entries, looked up by
+    perceptual image hash: a lookup returns the most recently used value whose
+    hash is within `max_distance` bits (Hamming distance) of the given hash.
+    Entries older than `ttl` seconds are considered expired. If `ttl` is
+    `None`, entries never expire.
+
+    Entries are also grouped (e.g. by request options), and only entries of the
+    same group match.
+    """
+
+    def __init__(self, max_distance: int, max_size: int, ttl: float = None):
+        if not 0 <= max_distance <= 64:
+            raise ValueError("Maximum distance must be between 0 and 64")
+        self.max_distance = max_distance
+        self._entries = ResultCache(max_size, ttl)
+
+    def get(self, group, phash: int):
+        """Returns the value cached for the nearest recent hash to the given
+        `phash` in the given `group`, or `None` if there is none."""
+        candidates = [key for key in self._entries.recent_keys()
+                      if key[0] == group and
+                      bin(key[1] ^ phash).count("1") <= self.max_distance]
+        for key in candidates:
+            value = self._entries.get(key)
+            if value is not None:
+                return value
+        return None
+
+    def put(self, group, phash: int, value):
+        """Caches the given `value` for the given `phash` in the given
+        `group`."""
+        self._entries.put((group, phash), value)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class CachedPredictor:
+    """Serves requests for a service from its caches, passing only the requests
+    that are not cached to the underlying `predictor` (the service or its
+    scheduler).
+
+    Requests are identified by their options (all the keys of the request
+    except the image) and their image: a hash of its decoded bytes for the
+    exact `cache`, and its perceptual hash and coarse color signature for the
+    `near_cache` (see `NearDuplicateCache`). Either cache may be `None`. Only
+    successful results are cached.
+    """
+
+    def __init__(self, service_name: str, predictor, cache: ResultCache = None,
+                 near_cache: NearDuplicateCache = None):
+        self.service_name = service_name
+        self.predictor = predictor
+        self.cache = cache
+        self.near_cache = near_cache
+
+    def predict(self, req: dict) -> (str, float):
+        keys, result = self.__lookup(req)
+        if result is None:
+            result = self.predictor.predict(req)
+            self.__store(keys, result)
+        return result
+
+    async def predict_async(self, req: dict) -> (str, float):
+        # the lookup decodes and hashes the image (and decodes it fully for
+        # the perceptual hash); keep that off the event loop, and out of the
+        # slots of the model calls
+        loop = asyncio.get_running_loop()
+        keys, result = await loop.run_in_executor(
+            get_decode_executor(), self.__lookup, req)
+        if result is None:
+            result = await self.predictor.predict_async(req)
+            self.__store(keys, result)
+        return result
+
+    def predict_batch(self, reqs: list) -> list:
+        lookups = [self.__lookup(req) for req in reqs]
+        results = [result for _, result in lookups]
+        misses = [index for index, result in enumerate(results)
+                  if result is None]
+        if misses:
+            predictions = self.predictor.predict_batch(
+                [reqs[index] for index in misses])
+            for index, result in zip(misses, predictions):
+                results[index] = result
+                if not isinstance(result, Exception):
+                    self.__store(lookups[index][0], result)
+        return results
+
+    def __lookup(self, req: dict):
+        """Returns the cache keys of the given `req`uest and its cached result
+        (or `None`). The keys are `None` if the request has no valid image or
+        its image cannot be decoded (the service reports the error)."""
+        # imported here so that importing the API does not import the image
+        # libraries
+        from .services.common import base64_to_image_obj
+        try:
+            image_obj = base64_to_image_obj(req)
+            options = json.dumps({name: value for name, value in req.items()
+                                  if name != "image" and not name.startswith("_")},
+                                 sort_keys=True)
+            group = (self.service_name, options)
+            near_key = None
+            if self.near_cache:
+                # the perceptual hash ignores color; only images with the same
+                # coarse colors count as near duplicates
+                near_key = (group + (image_obj.color_signature,),
+                            image_obj.dhash)
+            keys = ((group, image_obj.digest), near_key)
+        except Exception:
+            # whatever fails here fails for this request only, and is reported
+            # by the service
+            return None, None
+        result = None
+        if self.cache:
+            result = self.cache.get(keys[0])
+        if result is None and self.near_cache:
+            result = self.near_cache.get(*near_key)
+        return keys, result
+
+    def __store(self, keys, result):
+        if keys is None:
+            return
+        key, near_key = keys
+        if self.cache:
+            self.cache.put(key, result)
+        if self.near_cache:
+            self.near_cache.put(*near_key, result)
+
+
+def create_cache(config: dict):
+    """Creates a `ResultCache` from the `cache` object of the given service
+    `config`, which has the keys `max_size` (number of entries) and `ttl`
+    (seconds, optional).
+
+    Returns `None` if caching is not configured.
+    """
+    cache_config = (config or {}).get("cache", None)
+    if not cache_config:
+        return None
+    return ResultCache(max_size=cache_config["max_size"],
+                       ttl=cache_config.get("ttl", None))
+
+
+def create_near_duplicate_cache(config: dict):
+    """Creates a `NearDuplicateCache` from the `near_duplicate` object of the
+    given service `config`, which has the keys `max_distance` (bits),
+    `max_size` (number of entries) and `ttl` (seconds, optional).
+
+    Returns `None` if near-duplicate caching is not configured.
+    """
+    cache_config = (config or {}).get("near_duplicate", None)
+    if not cache_config:
+        return None
+    return NearDuplicateCache(max_distance=cache_config["max_distance"],
+                              max_size=cache_config["max_size"],
+                              ttl=cache_config.get("ttl", None))
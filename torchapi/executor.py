@@ -0,0 +1,62 @@
+"""Torch executor
+
+Bounded thread pools, owned by the Torch API, on which work is run when the
+API is used asynchronously: CPU-bound model calls on one pool, and the
+decoding and hashing of request images (e.g. for cache lookups) on another, so
+that this lighter work neither blocks the event loop nor takes the slots that
+bound the model calls.
+"""
+
+__author__ = "Omar Othman"
+
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import get_config
+
+# default number of model calls that may run concurrently
+_DEFAULT_MAX_WORKERS = 2
+
+# default number of request images that may be decoded concurrently
+_DEFAULT_DECODE_WORKERS = 2
+
+# executors by the configuration key of their number of workers
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Returns the executor shared by the whole API, creating it on first use.
+
+    The number of worker threads is read from the `max_workers` key of the
+    `executor` configuration and bounds the number of model calls that run
+    concurrently.
+    """
+    return _get_executor("max_workers", _DEFAULT_MAX_WORKERS, "torch")
+
+
+def get_decode_executor() -> ThreadPoolExecutor:
+    """Returns the executor on which the API decodes and hashes request images
+    outside of the event loop, creating it on first use.
+
+    The number of worker threads is read from the `decode_workers` key of the
+    `executor` configuration.
+    """
+    return _get_executor("decode_workers", _DEFAULT_DECODE_WORKERS,
+                         "torch-decode")
+
+
+def _get_executor(key: str, default_workers: int,
+                  name: str) -> ThreadPoolExecutor:
+    with _executor_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            config = get_config("executor") or {}
+            max_workers = config.get(key, default_workers)
+            if max_workers < 1:
+                raise ValueError("Executor must have at least 1 worker")
+            executor = ThreadPoolExecutor(max_workers=max_workers,
+                                          thread_name_prefix=name)
+            _executors[key] = executor
+        return executor
@@ -1,35 +1,280 @@
 """Torch logger
 
 Logs messages from the Torch API into a log file.
+
+Messages are queued and written by a background thread, which keeps the log
+file open, flushes it periodically and rotates it when it grows too large, so
+logging never blocks the caller on file I/O. Processes sharing the log file
+(e.g. the workers of `torchapi.serve`) rotate it under a file lock, so it is
+rotated once however many processes reach the size limit. Messages that cannot
+be written to the file (e.g. because the disk is full) are written to the
+standard error instead. The writer is configured by the `logger` object of the
+configuration file:
+
+- `level`: the lowest level that is logged (see `log`). Default is `v`.
+- `max_bytes`: the size at which the log file is rotated. Default is 10 MB. If
+`0`, the file is never rotated.
+- `backup_count`: the number of rotated files to keep (`torch.log.1`,
+`torch.log.2`, ...). Default is 3.
+- `flush_interval`: the maximum time (in seconds) a message stays in memory
+before being written to the file. Must be positive. Default is 1.
 """
 
 __author__ = "Omar Othman"
 
 
+import atexit
 import datetime
 import os
+import queue
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not on POSIX; only a single process can write the log file
+    fcntl = None
+
+from .util import get_config
 
 _LOCAL_PATH = os.path.dirname(__file__)
 _LOG_FILENAME = os.path.join(_LOCAL_PATH, "torch.log")
 
+# log levels in increasing order of severity
+_LEVELS = "vdiwe"
+
+# maximum time (in seconds) `flush` waits for the writer thread
+_FLUSH_TIMEOUT = 5
+
+
+class _LogWriter:
+    """Writes queued log records to a file from a background thread."""
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int,
+                 flush_interval: float):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # guards the file, which the writer thread and `fork` both touch
+        self._file_lock = threading.Lock()
+        self._file = None
+        # the size of the log file as last seen by this process, plus what it
+        # wrote since
+        self._size = 0
+        # whether the last write to the file failed
+        self._failing = False
+
+    def write(self, record):
+        """Queues the given `record`, a tuple (timestamp, level, tag, msg)."""
+        self._ensure_started()
+        self._queue.put(record)
+
+    def flush(self):
+        """Blocks until all the records queued so far are written, or for at
+        most `_FLUSH_TIMEOUT` seconds."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(_FLUSH_TIMEOUT)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="torch-logger", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = None
+            while record is not None:
+                if isinstance(record, threading.Event):
+                    try:
+                        self._flush_file()
+                    except OSError as err:
+                        self._fail(err)
+                    # set whatever happened, so that `flush` never hangs
+                    record.set()
+                else:
+                    line = self._format(record)
+                    try:
+                        self._emit(line)
+                    except OSError as err:
+                        self._fail(err, line)
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    record = None
+            if time.monotonic() - last_flush >= self.flush_interval:
+                try:
+                    self._flush_file()
+                except OSError as err:
+                    self._fail(err)
+                last_flush = time.monotonic()
+
+    @staticmethod
+    def _format(record) -> str:
+        timestamp, level, tag, msg = record
+        return (f"{str(datetime.datetime.fromtimestamp(timestamp))} - "
+                f"{level} [{tag}] {msg}\n")
+
+    def _emit(self, line: str):
+        with self._file_lock:
+            if self._file is None:
+                self._open()
+            self._file.write(line)
+            self._size += len(line)
+            if self.max_bytes and self._size >= self.max_bytes:
+                self._rotate()
+        self._failing = False
+
+    def _fail(self, err: OSError, line: str = None):
+        """Handles a failure to write the log file: the file is reopened for
+        the next record, and the given `line` is written to the standard
+        error instead."""
+        with self._file_lock:
+            if self._file is not None:
+                try:
+                    self._file.close()
+                except OSError:
+                    pass
+                self._file = None
+        if not self._failing:
+            # reported once until a write succeeds again
+            sys.stderr.write(f"Could not write to {self.filename}: {err}\n")
+            self._failing = True
+        if line is not None:
+            sys.stderr.write(line)
+
+    def _flush_file(self):
+        with self._file_lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            # another process may have rotated the file; follow it
+            if self._rotated():
+                self._file.close()
+                self._file = None
+            else:
+                # include what other processes wrote
+                self._size = os.fstat(self._file.fileno()).st_size
+
+    def _rotated(self) -> bool:
+        """Returns whether the open file is no longer the log file."""
+        try:
+            return os.stat(self.filename).st_ino != \
+                os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _open(self):
+        self._file = open(self.filename, "a")
+        self._size = os.fstat(self._file.fileno()).st_size
+
+    def _rotate(self):
+        self._file.flush()
+        if fcntl is None:
+            self._rotate_file()
+            return
+        with open(f"{self.filename}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # check again under the lock: another process may have rotated the
+            # file in the meantime
+            if self._rotated():
+                self._file.close()
+                self._open()
+            elif os.fstat(self._file.fileno()).st_size >= self.max_bytes:
+                self._rotate_file()
+            else:
+                self._size = os.fstat(self._file.fileno()).st_size
+            # unlocked when closed
+
+    def _rotate_file(self):
+        self._file.close()
+        self._file = None
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f"{self.filename}.{i}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.filename}.{i + 1}")
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+        self._open()
+
+    def _before_fork(self):
+        # nothing buffered in the parent may be written twice by the child
+        self._file_lock.acquire()
+        if self._file is not None:
+            self._file.flush()
+
+    def _after_fork_in_parent(self):
+        self._file_lock.release()
+
+    def _after_fork_in_child(self):
+        self._file_lock.release()
+        # records queued in the parent are written by the parent
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+
+_CONFIG = get_config("logger") or {}
+_MIN_LEVEL = _CONFIG.get("level", "v")
+if len(_MIN_LEVEL) != 1 or _MIN_LEVEL not in _LEVELS:
+    raise Exception('Invalid log level in configuration')
+_FLUSH_INTERVAL = _CONFIG.get("flush_interval", 1)
+# a non-positive interval would make the writer thread spin
+if not isinstance(_FLUSH_INTERVAL, (int, float)) or _FLUSH_INTERVAL <= 0:
+    raise Exception('Invalid flush interval in configuration')
+_WRITER = _LogWriter(_LOG_FILENAME,
+                     max_bytes=_CONFIG.get("max_bytes", 10 * 1024 * 1024),
+                     backup_count=_CONFIG.get("backup_count", 3),
+                     flush_interval=_FLUSH_INTERVAL)
+atexit.register(_WRITER.flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_WRITER._before_fork,
+                        after_in_parent=_WRITER._after_fork_in_parent,
+                        after_in_child=_WRITER._after_fork_in_child)
+
 
 def log(tag: str, msg: str, level: str = "d"):
     """Logs the given `msg` tagged with the given `tag` having the given `level`
     to the default log file.
 
+    Messages below the level configured for the logger are discarded.
+
     ### Arguments
-    `level`: could be one of
+    `level`: could be one of (in increasing order of severity)
     - `v` (verbose)
-    - `i` (info)
     - `d` (debug)
+    - `i` (info)
     - `w` (warning)
     - `e` (error)
     """
-    if len(level) != 1 or level not in 'vidwe':
+    if len(level) != 1 or level not in _LEVELS:
         raise Exception('Invalid log level')
-    with open(_LOG_FILENAME, "a") as log_file:
-        log_file.write(
-            f"{str(datetime.datetime.now())} - {level} [{tag}] {msg}\n")
+    if _LEVELS.index(level) < _LEVELS.index(_MIN_LEVEL):
+        return
+    _WRITER.write((time.time(), level, tag, msg))
+
+
+def flush():
+    """Blocks until all messages logged so far are written to the log file."""
+    _WRITER.flush()
 
 
 def log_e(tag: str, msg: str):
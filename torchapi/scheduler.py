@@ -0,0 +1,151 @@
+"""Torch scheduler
+
+Collects concurrent requests for the same service into micro-batches so that
+model-backed services run one forward pass for many callers.
+"""
+
+__author__ = "Omar Othman"
+
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .logger import log_e, log_i
+
+
+class MicroBatcher:
+    """Schedules requests for a single `service` in micro-batches.
+
+    Calls to `predict` from concurrent threads are queued. A background thread
+    takes the first queued request, waits for up to `max_wait` seconds for more
+    requests (or until `max_batch` requests are collected), and passes them all
+    to `service.predict_batch` at once. Each caller then receives its own
+    result.
+
+    ### Arguments
+    `service`: the `Service` to schedule requests for.
+
+    `max_batch`: the maximum number of requests in a single batch.
+
+    `max_wait`: the maximum time (in seconds) to wait for a batch to fill up
+    after its first request arrives.
+    """
+
+    def __init__(self, service, max_batch: int, max_wait: float):
+        if max_batch < 1:
+            raise ValueError("Maximum batch size must be at least 1")
+        if max_wait < 0:
+            raise ValueError("Maximum wait time cannot be negative")
+        self.service = service
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, req: dict) -> Future:
+        """Queues the given `req`uest and returns a `Future` that resolves to
+        the `(prediction, confidence)` of the request, or raises the
+        `TorchException` of the request.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((req, future))
+        return future
+
+    def predict(self, req: dict) -> (str, float):
+        """Queues the given `req`uest and blocks until its batch is processed.
+
+        Behaves the same as calling `predict` on the service directly.
+        """
+        return self.submit(req).result()
+
+    async def predict_async(self, req: dict) -> (str, float):
+        """Coroutine version of `predict`. Awaits the batch of the `req`uest
+        without blocking the event loop.
+        """
+        return await asyncio.wrap_future(self.submit(req))
+
+    def predict_batch(self, reqs: list) -> list:
+        """Queues all the given `reqs` and blocks until they are processed.
+
+        See `Service.predict_batch` for the format of the returned list;
+        requests that fail unexpectedly get the exception they raised.
+        """
+        futures = [self.submit(req) for req in reqs]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as exception:
+                # other requests of the batch must still get their results
+                results.append(exception)
+        return results
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f"batcher-{self.service.service_name}",
+                    daemon=True)
+                self._thread.start()
+                log_i(self.service.service_name, "Micro-batching started")
+
+    def _next_batch(self) -> list:
+        """Blocks until a request is available and then collects a batch."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            reqs = [req for req, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.service.predict_batch(reqs)
+            except Exception as err:
+                # an unexpected error must only fail the request that caused
+                # it, so the requests of the batch are run again one by one
+                log_e(self.service.service_name, str(err))
+                results = [self._run_single(req) for req in reqs]
+            for future, result in zip(futures, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _run_single(self, req: dict):
+        """Runs the given `req`uest on its own and returns its result, or the
+        exception it raised."""
+        try:
+            return self.service.predict_batch([req])[0]
+        except Exception as err:
+            log_e(self.service.service_name, str(err))
+            return err
+
+
+def create_batcher(service, config: dict):
+    """Creates a `MicroBatcher` for the given `service` if micro-batching is
+    enabled in its `config`, i.e. `max_batch` is greater than 1.
+
+    `max_wait_ms` is the time (in milliseconds) a batch waits to fill up and
+    defaults to 5.
+
+    Returns `None` if micro-batching is not enabled.
+    """
+    if not config or config.get("max_batch", 1) <= 1:
+        return None
+    return MicroBatcher(service, max_batch=config["max_batch"],
+                        max_wait=config.get("max_wait_ms", 5) / 1000)
@@ -0,0 +1,220 @@
+"""Torch server
+
+Serves the Torch API over a local (Unix domain) socket using a pool of
+pre-forked worker processes. Run
+
+    python -m torchapi.serve --socket /tmp/torch.sock --workers 8
+
+The master process loads the models of the preloaded services once and then
+forks the workers, which share the loaded weights copy-on-write instead of each
+holding its own copy. Dead workers are replaced by the master.
+
+Clients send one JSON request (or JSON array of requests, see
+`torchapi.handle_batch`) per line and receive one JSON response per line, in the
+same order.
+
+TensorFlow's thread pools do not survive `fork`. By default, the master only
+loads the services that keep working in forked workers (see
+`torchapi.api.is_fork_safe`): those that do not run TensorFlow, e.g. `banknote`
+with the `tflite` or `onnx` backend. Every worker loads the other models itself
+after forking. With the default configuration (`banknote` on `keras`,
+`object_detection` on `tensorflow`), this means that no model weights are
+shared and every worker holds its own copy of every model. The master never
+runs a model; each worker runs its models once before accepting connections.
+`--preload all` loads every model in the master and `--preload none` none of
+them. Run `python -m tests modules fork_test` to check that the configured
+services work in a forked worker.
+
+The `tflite` backend converts the Keras model in the process loading it if no
+converted model is found in the assets. Warm up the service once beforehand
+(`torchapi.warmup(["banknote"])`) so that the master never runs TensorFlow.
+
+Only available on POSIX systems.
+"""
+
+__author__ = "Omar Othman"
+
+
+import argparse
+import gc
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from .api import handle, handle_batch, load_services, warmup
+from .logger import log_e, log_i
+from .util import error_response
+
+_TAG = "serve"
+
+# seconds to wait before replacing a dead worker
+_RESPAWN_DELAY = 1
+
+_INVALID_REQUEST_ERROR = json.dumps(
+    error_response(origin="server", msg="Invalid request"))
+_INTERNAL_ERROR = json.dumps(
+    error_response(origin="server", msg="Internal error"))
+
+# which services the master loads before forking the workers
+_PRELOAD_MODES = ("fork-safe", "all", "none")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m torchapi.serve",
+        description="Serves the Torch API to local clients over a Unix socket "
+        "using pre-forked worker processes.")
+    parser.add_argument("--socket", default="/tmp/torch.sock",
+                        help="path of the Unix socket to listen on")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes")
+    parser.add_argument("--services", nargs="*", default=None,
+                        help="services to load upfront (default: all); other "
+                        "services are loaded by each worker on first use")
+    parser.add_argument("--preload", choices=_PRELOAD_MODES,
+                        default="fork-safe",
+                        help="services whose models are loaded in the master "
+                        "and shared by the workers (default: fork-safe); the "
+                        "others are loaded by each worker after forking")
+    args = parser.parse_args()
+
+    if not hasattr(os, "fork") or not hasattr(socket, "AF_UNIX"):
+        sys.exit("The Torch server requires a POSIX system")
+    if args.workers < 1:
+        sys.exit("There must be at least 1 worker")
+
+    if args.preload != "none":
+        services = load_services(
+            args.services, fork_safe_only=args.preload == "fork-safe")
+        log_i(_TAG, f"Preloaded {', '.join(services) or 'no services'}")
+        # move everything loaded so far out of the garbage collector's reach
+        # so that collections in the workers do not touch (and copy) the pages
+        # holding the models
+        gc.freeze()
+
+    listener = _listen(args.socket)
+    log_i(_TAG, f"Listening on {args.socket} with {args.workers} workers")
+
+    workers = set()
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            _kill(pid)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        while not stopping:
+            while len(workers) < args.workers and not stopping:
+                workers.add(_fork_worker(listener, args))
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                continue
+            except InterruptedError:
+                continue
+            workers.discard(pid)
+            if not stopping:
+                log_e(_TAG, f"Worker {pid} exited with status {status}")
+                # avoid a tight respawn loop if workers keep failing
+                time.sleep(_RESPAWN_DELAY)
+    finally:
+        stop()
+        for pid in list(workers):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        listener.close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        log_i(_TAG, "Stopped")
+
+
+def _listen(path: str) -> socket.socket:
+    """Binds a Unix socket to the given `path`, replacing any stale socket
+    file left there."""
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    return listener
+
+
+def _kill(pid: int):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def _fork_worker(listener: socket.socket, args) -> int:
+    """Forks a worker serving connections on the given `listener` and returns
+    its PID in the master."""
+    pid = os.fork()
+    if pid:
+        return pid
+    # worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        # loads the services that were not preloaded
+        warmup(args.services)
+        _serve(listener)
+    except BaseException as err:
+        log_e(_TAG, f"Worker {os.getpid()} failed: {err}")
+    finally:
+        os._exit(1)
+
+
+def _serve(listener: socket.socket):
+    """Accepts connections forever, serving each in its own thread so that
+    concurrent requests within a worker can be micro-batched."""
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=_serve_connection, args=(conn,),
+                         daemon=True).start()
+
+
+def _serve_connection(conn: socket.socket):
+    try:
+        with conn, conn.makefile("rb") as reader, \
+                conn.makefile("wb") as writer:
+            for line in reader:
+                line = line.strip()
+                if not line:
+                    continue
+                writer.write(_respond(line).encode("utf-8") + b"\n")
+                writer.flush()
+    except OSError:
+        # the client went away
+        pass
+
+
+def _respond(line: bytes) -> str:
+    """Returns the JSON response to a single line (request) of a client."""
+    try:
+        req = line.decode("utf-8")
+        if req.startswith("["):
+            return handle_batch(req)
+        return handle(req)
+    except (ValueError, KeyError, TypeError, AttributeError) as err:
+        log_e(_TAG, f"Invalid request: {err}")
+        return _INVALID_REQUEST_ERROR
+    except Exception as err:
+        # a failing request must not close the connection of the client
+        log_e(_TAG, f"Could not handle request: {err!r}")
+        return _INTERNAL_ERROR
+
+
+if __name__ == "__main__":
+    main()
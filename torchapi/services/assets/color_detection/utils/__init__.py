@@ -1,3 +1,7 @@
 from .color_feature_extraction import histogram_of_test_image
+from .color_feature_extraction import histograms_of_frames
+from .color_feature_extraction import histogram_of_image_file
+from .color_feature_extraction import features_of_frames
 from .color_feature_extraction import histogram_of_training_image
-from .knn_classifier import classify
\ No newline at end of file
+from .knn_classifier import classify
+from .knn_classifier import ColorKnnModel
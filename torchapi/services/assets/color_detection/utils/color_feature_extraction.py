@@ -4,50 +4,91 @@ import numpy as np
 import os
 
 path=os.path.dirname(__file__)
-def histogram_of_test_image(test_image,frame=None):
-    image=cv2.imread(test_image)
 
+# supported feature modes:
+# - peak: the peak r, g, b values of the histograms (3 values)
+# - hsv: the normalized hue/saturation/value histogram (bins ** 3 values)
+# - quantized: the normalized color histogram with the given number of bins
+#   per channel (bins ** 3 values)
+FEATURE_MODES = ('peak', 'hsv', 'quantized')
+
+# returns the feature vector (peak r, g, b) of the image, or of the given
+# frame (ymin, xmin, ymax, xmax relative to the image size) of it
+def histogram_of_test_image(image,frame=None):
+    return histograms_of_frames(image, [frame])[0]
+
+# returns the feature vectors of all the given frames of the image as an
+# array of shape (n, 3); a frame of None is the whole image.
+# The frames are sliced from the image as views (no pixels are copied) and
+# the histograms are computed on the views directly.
+# image is a BGR array, as read by cv2.imread, unless channel_order is 'rgb'
+def histograms_of_frames(image, frames, channel_order='bgr'):
+    # channel indexes of r, g and b in the image
+    channels = (2, 1, 0) if channel_order == 'bgr' else (0, 1, 2)
+    features = np.empty((len(frames), 3), dtype=np.float64)
+    for i, frame in enumerate(frames):
+        features[i] = __calculate_histogram(__crop(image, frame), channels)
+    return features
+
+# returns the feature vectors of the given mode (see FEATURE_MODES) of all the
+# given frames of the image, as an array of shape (n, d)
+def features_of_frames(image, frames, mode='peak', bins=4, channel_order='bgr'):
+    if mode == 'peak':
+        return histograms_of_frames(image, frames, channel_order)
+    channels = (2, 1, 0) if channel_order == 'bgr' else (0, 1, 2)
+    features = np.empty((len(frames), feature_length(mode, bins)),
+                        dtype=np.float64)
+    for i, frame in enumerate(frames):
+        crop = __crop(image, frame)
+        if mode == 'hsv':
+            conversion = cv2.COLOR_BGR2HSV if channel_order == 'bgr' else cv2.COLOR_RGB2HSV
+            hist = cv2.calcHist([cv2.cvtColor(crop, conversion)], [0, 1, 2],
+                                None, [bins] * 3, [0, 180, 0, 256, 0, 256])
+        elif mode == 'quantized':
+            hist = cv2.calcHist([crop], list(channels), None, [bins] * 3,
+                                [0, 256] * 3)
+        else:
+            raise Exception("Unknown feature mode: "+str(mode))
+        # normalized, so that frames of any size are comparable
+        features[i] = hist.ravel() / max(hist.sum(), 1)
+    return features
+
+# returns the length of the feature vectors of the given mode
+def feature_length(mode='peak', bins=4):
+    if mode == 'peak':
+        return 3
+    if mode in ('hsv', 'quantized'):
+        return bins ** 3
+    raise Exception("Unknown feature mode: "+str(mode))
+
+# returns a view of the given frame (ymin, xmin, ymax, xmax relative to the
+# image size) of the image, or the image itself if the frame is None
+def __crop(image, frame):
     if frame is None:
-        feature_data = __calculate_histogram(image)
-    else:
-        im_height,im_width,_ = image.shape
-        ymin, xmin, ymax, xmax = frame
-        feature_data = __calculate_histogram(image[(int) (ymin * im_height):(int)(ymax * im_height) ,(int)(xmin * im_width):(int)(xmax * im_width)])
-    
-    try:
-        with open(os.path.join(path, 'test.data'), "w") as myfile:
-            myfile.write(feature_data)
-    except:
-        raise Exception("Test data histogram could not load.")
-
-def __calculate_histogram(image:cv2):
-    chans = cv2.split(image)
-    colors = ('b', 'g', 'r')
-    features = []
-    feature_data = ''
-    counter = 0
-    for (chan, color) in zip(chans, colors):
-        counter = counter + 1
-
-        hist = cv2.calcHist([chan], [0], None, [256], [0, 256])
-        features.extend(hist)
-
-        # find the peak pixel values for R, G, and B
-        elem = np.argmax(hist)
-
-        if counter == 1:
-            blue = str(elem)
-        elif counter == 2:
-            green = str(elem)
-        elif counter == 3:
-            red = str(elem)
-            feature_data = red + ',' + green + ',' + blue
-    return feature_data
+        return image
+    im_height,im_width,_ = image.shape
+    ymin, xmin, ymax, xmax = frame
+    return image[(int) (ymin * im_height):(int)(ymax * im_height) ,(int)(xmin * im_width):(int)(xmax * im_width)]
+
+# returns the peak pixel values of the given channels of the image
+def __calculate_histogram(image:cv2, channels=(2, 1, 0)):
+    peaks = []
+    for channel in channels:
+        hist = cv2.calcHist([image], [channel], None, [256], [0, 256])
+        peaks.append(np.argmax(hist))
+    return np.array(peaks, dtype=np.float64)
+
+# returns the feature vector of the given mode (peak r, g, b by default) of the
+# image file at the given path
+def histogram_of_image_file(image_path, mode='peak', bins=4):
+    image=cv2.imread(image_path)
+    if image is None:
+        raise Exception("Image could not load: "+image_path)
+    return features_of_frames(image, [None], mode, bins)[0]
 
 # add color histogram of training image
 def histogram_of_training_image(training_image,data_source):
-    image=cv2.imread(training_image)
-    feature_data= __calculate_histogram(image)
+    feature_data = ','.join(str(int(value)) for value in histogram_of_image_file(training_image))
     try:
         with open(os.path.join(path, 'training.data'), "a") as myfile:
             myfile.write(feature_data + ',' + data_source + '\n')
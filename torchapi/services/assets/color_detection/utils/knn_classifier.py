@@ -1,90 +1,269 @@
 import csv
-import random
-import math
-import operator
-import cv2
+import itertools
 import os
+import threading
+import time
+
+import numpy as np
+
+from ....common import atomic_write
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 
 path=os.path.dirname(__file__)
 
-# calculation of euclidean distance
-def calculateEuclideanDistance(variable1, variable2, length):
-    distance = 0
-    for x in range(length):
-        distance += pow(variable1[x] - variable2[x], 2)
-    return math.sqrt(distance)
-
-
-# get k nearest neigbors
-def kNearestNeighbors(training_feature_vector, testInstance, k):
-    distances = []
-    length = len(testInstance)
-    for x in range(len(training_feature_vector)):
-        dist = calculateEuclideanDistance(testInstance,
-                training_feature_vector[x], length)
-        if (dist == 0):
-            distances.append((training_feature_vector[x], dist))
-        distances.append((training_feature_vector[x], dist))
-    distances.sort(key=operator.itemgetter(1))
-    neighbors = []
-    for x in range(k):
-        neighbors.append(distances[x][0])
-    return neighbors
-
-
-# votes of neighbors
-def responseOfNeighbors(neighbors):
-    all_possible_neighbors = {}
-    for x in range(len(neighbors)):
-        response = neighbors[x][-1]
-        if response in all_possible_neighbors:
-            all_possible_neighbors[response] += 1
+# number of color channels in a feature vector
+FEATURE_LENGTH = 3
+
+
+# Load a feature data file (rows of r,g,b[,label]) into a float array of
+# shape (n, 3) and a list of the labels (empty if the rows have no label)
+def loadFeatureFile(file_name):
+    features = []
+    labels = []
+    with open(os.path.join(path, file_name)) as csvfile:
+        for row in csv.reader(csvfile):
+            if not row:
+                continue
+            features.append([float(value) for value in row[:FEATURE_LENGTH]])
+            if len(row) > FEATURE_LENGTH:
+                labels.append(row[FEATURE_LENGTH])
+    return np.array(features, dtype=np.float64).reshape(-1, FEATURE_LENGTH), labels
+
+
+# directory of the binary sample store with the given name in this directory.
+# Every call to `ColorKnnModel.add_samples` adds one chunk file to it, holding
+# the added features (float array of shape (m, d)) and labels (string array),
+# so that adding samples never rewrites the samples added before, and
+# processes adding samples to the same store never overwrite each other.
+def storePath(store_name):
+    return os.path.join(path, store_name)
+
+
+# Load the binary sample store with the given name, holding feature vectors of
+# the given length, in the order the chunks were added. Returns empty arrays if
+# the store does not exist yet.
+def loadSampleStore(store_name, feature_length=FEATURE_LENGTH):
+    store_path = storePath(store_name)
+    features = [np.empty((0, feature_length), dtype=np.float64)]
+    labels = []
+    if not os.path.isdir(store_path):
+        return features[0], labels
+    # temporary files of chunks being added are skipped
+    for chunk_name in sorted(name for name in os.listdir(store_path)
+                             if name.endswith('.npz')):
+        with np.load(os.path.join(store_path, chunk_name)) as chunk:
+            chunk_features = chunk['features']
+            chunk_labels = chunk['labels'].tolist()
+        if chunk_features.ndim != 2 or \
+                chunk_features.shape[1] != feature_length or \
+                len(chunk_features) != len(chunk_labels):
+            raise Exception("Sample store is corrupted: "+store_name)
+        features.append(chunk_features)
+        labels += chunk_labels
+    return np.concatenate(features).astype(np.float64, copy=False), labels
+
+
+# numbers the chunks added by this process
+_chunk_counter = itertools.count()
+
+
+# Add the given features and labels to the binary sample store with the given
+# name as a new chunk. The chunk is written atomically, so readers never see a
+# partially written chunk.
+def appendSampleStore(store_name, features, labels):
+    store_path = storePath(store_name)
+    os.makedirs(store_path, exist_ok=True)
+    # chunks sort in the order they were added; the process id and counter
+    # keep the names unique
+    chunk_name = '%020d_%d_%d' % (time.time_ns(), os.getpid(),
+                                  next(_chunk_counter))
+    atomic_write(os.path.join(store_path, chunk_name + '.npz'),
+                 lambda chunk_file: np.savez(
+                     chunk_file,
+                     features=np.asarray(features, dtype=np.float64),
+                     labels=np.array(labels, dtype=str)))
+
+
+class ColorKnnModel:
+    """K nearest neighbors color classifier.
+
+    The training features are loaded once into memory, and feature vectors
+    are classified in batches with vectorized distances. Features with more
+    than 3 dimensions are searched with a KD-tree built once over the training
+    set, if SciPy is available.
+
+    ### Arguments
+    `training_file`: name of the training data file (rows of r,g,b,label)
+    in this directory. If `None`, the model is trained only from the samples
+    of its store, and cannot classify until it has at least `k` samples.
+
+    `k`: the number of neighbors that vote for the class.
+
+    `store_name`: name of the binary sample store in this directory that
+    samples added with `add_samples` are appended to, and loaded from along
+    with the training file. If `None`, added samples are only kept in memory.
+
+    `feature_length`: the length of the feature vectors, if there is no
+    training file.
+    """
+
+    # minimum number of added samples searched by brute force before the
+    # KD-tree is rebuilt to include them
+    _REBUILD_MIN = 64
+
+    # number of neighbors fetched from the KD-tree beyond k
+    _TIE_MARGIN = 8
+
+    def __init__(self, training_file='training.data', k=3, store_name=None,
+                 feature_length=FEATURE_LENGTH):
+        if training_file is None:
+            features = np.empty((0, feature_length), dtype=np.float64)
+            labels = []
         else:
-            all_possible_neighbors[response] = 1
-    sortedVotes = sorted(all_possible_neighbors.items(),
-                         key=operator.itemgetter(1), reverse=True)
-    return sortedVotes[0][0]
-
-
-# Load image feature data to training feature vectors and test feature vector
-def loadDataset(
-    training_file,
-    test_file,
-    training_feature_vector=[],
-    test_feature_vector=[],
-    ):
-    try:
-        with open(os.path.join(path, training_file)) as csvfile:
-            lines = csv.reader(csvfile)
-            dataset = list(lines)
-            for x in range(len(dataset)):
-                for y in range(3):
-                    dataset[x][y] = float(dataset[x][y])
-                training_feature_vector.append(dataset[x])
-    except:
-        raise Exception("Traininig file could not load: "+training_file)
-
-    try:
-        
-        with open(os.path.join(path, test_file)) as csvfile:
-            lines = csv.reader(csvfile)
-            dataset = list(lines)
-            for x in range(len(dataset)):
-                for y in range(3):
-                    dataset[x][y] = float(dataset[x][y])
-                test_feature_vector.append(dataset[x])
-    except:
-        raise Exception("Test file could not load: "+test_file)
-
-
-def classify(training_data, test_data):
-    training_feature_vector = []  # training feature vector
-    test_feature_vector = []  # test feature vector
-    loadDataset(training_data,test_data, training_feature_vector, test_feature_vector)
-    classifier_prediction = []  # predictions
-    k = 3  # K value of k nearest neighbor
-    for x in range(len(test_feature_vector)):
-        neighbors = kNearestNeighbors(training_feature_vector, test_feature_vector[x], k)
-        result = responseOfNeighbors(neighbors)
-        classifier_prediction.append(result)
-    return classifier_prediction[0]
+            try:
+                features, labels = loadFeatureFile(training_file)
+            except Exception:
+                raise Exception("Traininig file could not load: "+training_file)
+            if len(labels) != len(features):
+                raise Exception("Training file has unlabelled rows: "+training_file)
+            if len(features) < k:
+                raise Exception("Training file has less than k rows: "+training_file)
+        self.feature_length = features.shape[1]
+        self.store_name = store_name
+        if store_name is not None:
+            stored_features, stored_labels = loadSampleStore(
+                store_name, self.feature_length)
+            features = np.concatenate([features, stored_features])
+            labels = labels + stored_labels
+        self.k = k
+        self.labels = labels
+
+        # the features live in a buffer with room to grow, so that adding
+        # samples does not copy the whole index every time. The buffer, the
+        # number of samples in it, the KD-tree and the number of samples in
+        # the tree are replaced together so that classifications running
+        # concurrently with `add_samples` see a consistent snapshot.
+        self.__lock = threading.Lock()
+        self.__use_tree = (cKDTree is not None and
+                           self.feature_length > FEATURE_LENGTH)
+        tree = cKDTree(features) if self.__use_tree and len(features) else None
+        self.__state = (features, len(features), tree, len(features))
+
+    @property
+    def trained(self):
+        """Whether the model has enough samples to classify."""
+        _, count, _, _ = self.__state
+        return count >= self.k
+
+    @property
+    def features(self):
+        """The training features, an array of shape (n, d)."""
+        buffer, count, _, _ = self.__state
+        return buffer[:count]
+
+    def add_samples(self, features, labels):
+        """Adds the given feature vectors (an array of shape (m, d)) with the
+        given labels to the training set. The samples are used by the next
+        classification and saved to the sample store, if any.
+        """
+        features = np.asarray(features, dtype=np.float64).reshape(
+            -1, self.feature_length)
+        labels = [str(label) for label in labels]
+        if len(labels) != len(features):
+            raise Exception("Every training sample must have one label")
+        if not len(labels):
+            return
+        with self.__lock:
+            buffer, old_count, tree, tree_count = self.__state
+            count = old_count + len(features)
+            if count > len(buffer):
+                new_buffer = np.empty((max(count, 2 * len(buffer)),
+                                       self.feature_length), dtype=np.float64)
+                new_buffer[:old_count] = buffer[:old_count]
+                buffer = new_buffer
+            buffer[old_count:count] = features
+            # samples not in the tree are searched by brute force until there
+            # are enough of them to make rebuilding the tree worth it
+            if self.__use_tree and \
+                    count - tree_count >= max(self._REBUILD_MIN, tree_count // 4):
+                tree = cKDTree(buffer[:count])
+                tree_count = count
+            # the labels are extended before the new state is published so
+            # that a concurrent classification never sees a feature without a
+            # label
+            self.labels.extend(labels)
+            self.__state = (buffer, count, tree, tree_count)
+            if self.store_name is not None:
+                appendSampleStore(self.store_name, features, labels)
+
+    def classify(self, features):
+        """Returns the predicted label of each of the given feature vectors,
+        an array of shape (m, d).
+        """
+        features = np.asarray(features, dtype=np.float64).reshape(
+            -1, self.feature_length)
+        buffer, count, tree, tree_count = self.__state
+        if count < self.k:
+            raise Exception("Not enough training samples to classify")
+        if tree is None:
+            # squared euclidean distances of shape (m, n); the square root
+            # does not change the order
+            distances = ((features[:, np.newaxis, :] -
+                          buffer[np.newaxis, :count, :]) ** 2).sum(axis=2)
+            return [self.__vote(row) for row in distances]
+
+        # the nearest neighbors in the tree, with a margin so that ties with
+        # the k-th neighbor can be broken in training order (as by brute
+        # force); if the margin is all ties, every sample as near as the k-th
+        # neighbor is fetched. They are merged with the samples added since
+        # the tree was built.
+        queried = min(self.k + self._TIE_MARGIN, tree_count)
+        tree_distances, tree_neighbors = tree.query(features, k=queried)
+        tree_distances = tree_distances.reshape(len(features), -1)
+        tree_neighbors = tree_neighbors.reshape(len(features), -1)
+        added_neighbors = np.arange(tree_count, count)
+        labels = []
+        for i, feature in enumerate(features):
+            candidates = tree_neighbors[i]
+            radius = tree_distances[i, self.k - 1] * (1 + 1e-9) + 1e-12
+            if queried < tree_count and tree_distances[i, -1] <= radius:
+                candidates = np.asarray(
+                    tree.query_ball_point(feature, radius), dtype=np.intp)
+            neighbors = np.concatenate([candidates, added_neighbors])
+            distances = ((buffer[neighbors] - feature) ** 2).sum(axis=1)
+            order = np.lexsort((neighbors, distances))[:self.k]
+            labels.append(self.__elect(distances[order], neighbors[order]))
+        return labels
+
+    def classify_one(self, feature):
+        """Returns the predicted label of the given feature vector."""
+        return self.classify([feature])[0]
+
+    def __vote(self, distances):
+        # the k nearest neighbors, nearest first (ties in training order)
+        kth_distance = np.partition(distances, self.k - 1)[self.k - 1]
+        candidates = np.flatnonzero(distances <= kth_distance)
+        order = np.argsort(distances[candidates], kind='stable')
+        neighbors = candidates[order[:self.k]]
+        return self.__elect(distances[neighbors], neighbors)
+
+    def __elect(self, distances, neighbors):
+        # an exact match in the training set decides the class
+        if distances[0] == 0:
+            return self.labels[neighbors[0]]
+
+        # majority vote; ties go to the label of the nearer neighbor
+        votes = {}
+        for neighbor in neighbors:
+            label = self.labels[neighbor]
+            votes[label] = votes.get(label, 0) + 1
+        return max(votes, key=votes.get)
+
+
+def classify(training_data, test_feature):
+    model = ColorKnnModel(training_data)
+    return model.classify_one(test_feature)
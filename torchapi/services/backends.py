@@ -0,0 +1,200 @@
+"""Inference backends
+
+Backends run a model on a batch of inputs, hiding the framework the model is
+run with. Every backend takes a NumPy array of inputs (one row per image) and
+returns the model outputs as a list of NumPy arrays, named by its
+`output_names`.
+
+Frameworks are imported when a backend is created, so that only the frameworks
+of the configured backends are imported.
+"""
+
+__author__ = "Omar Othman"
+
+
+from abc import ABC, abstractmethod
+import threading
+
+import numpy as np
+
+
+class Backend(ABC):
+    """Base class for all inference backends.
+
+    `output_names` holds the names of the model outputs, in the order they are
+    returned by `run`.
+    """
+
+    output_names = []
+
+    @abstractmethod
+    def run(self, inputs: np.ndarray) -> list:
+        """Runs the model on the given batch of `inputs` and returns its
+        outputs, one array per output with one row per input.
+        """
+        ...
+
+    def run_dict(self, inputs: np.ndarray) -> dict:
+        """Runs the model like `run` and returns its outputs by name."""
+        return dict(zip(self.output_names, self.run(inputs)))
+
+
+class KerasBackend(Backend):
+    """Runs a Keras h5 model.
+
+    `model.predict` builds a data pipeline on every call, which costs more than
+    the inference itself for small batches. The model is called directly
+    through a function compiled once for any batch size.
+
+    ### Arguments
+    `model_filename`: path of the h5 model file.
+
+    `input_shape`: the shape of a single input, e.g. `(224, 224, 3)`.
+    """
+
+    def __init__(self, model_filename: str, input_shape: tuple):
+        import tensorflow as tf
+        from tensorflow.keras.models import load_model
+        self.model = load_model(model_filename)
+        self.output_names = list(self.model.output_names)
+        self.__infer = tf.function(
+            lambda inputs: self.model(inputs, training=False),
+            input_signature=[tf.TensorSpec(
+                shape=(None,) + tuple(input_shape), dtype=tf.float32)])
+
+    def run(self, inputs: np.ndarray) -> list:
+        outputs = self.__infer(inputs)
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+        return [output.numpy() for output in outputs]
+
+
+class SavedModelBackend(Backend):
+    """Runs a signature of a TensorFlow saved model.
+
+    ### Arguments
+    `model_path`: path of the saved model directory.
+
+    `signature`: name of the signature to run. Default is `serving_default`.
+    """
+
+    def __init__(self, model_path: str, signature: str = "serving_default"):
+        import tensorflow as tf
+        self.__tf = tf
+        self.model = tf.saved_model.load(str(model_path))
+        self.__infer = self.model.signatures[signature]
+        self.output_names = sorted(self.__infer.structured_outputs)
+
+    def run(self, inputs: np.ndarray) -> list:
+        outputs = self.__infer(self.__tf.convert_to_tensor(inputs))
+        return [outputs[name].numpy() for name in self.output_names]
+
+
+class TFLiteBackend(Backend):
+    """Runs a TensorFlow Lite model with the TFLite interpreter.
+
+    The model takes one input at a time, so the inputs of a batch are run one
+    after the other. The interpreter is not thread-safe; concurrent calls to
+    `run` are serialized.
+
+    ### Arguments
+    `model_path`: path of the TFLite flatbuffer file.
+
+    `model_content`: the TFLite flatbuffer itself, if not loaded from a file.
+
+    `num_threads`: the number of threads of the interpreter. If `None`, the
+    interpreter's default is used.
+    """
+
+    def __init__(self, model_path: str = None, model_content: bytes = None,
+                 num_threads: int = None):
+        import tensorflow as tf
+        self.__interpreter = tf.lite.Interpreter(
+            model_path=model_path, model_content=model_content,
+            num_threads=num_threads)
+        self.__interpreter.allocate_tensors()
+        self.__input_index = self.__interpreter.get_input_details()[0]["index"]
+        output_details = self.__interpreter.get_output_details()
+        self.__output_indexes = [detail["index"] for detail in output_details]
+        self.output_names = [detail["name"] for detail in output_details]
+        self.__lock = threading.Lock()
+
+    def run(self, inputs: np.ndarray) -> list:
+        outputs = [[] for _ in self.__output_indexes]
+        with self.__lock:
+            for single_input in inputs:
+                self.__interpreter.set_tensor(self.__input_index,
+                                              single_input[np.newaxis])
+                self.__interpreter.invoke()
+                for output, index in zip(outputs, self.__output_indexes):
+                    output.append(self.__interpreter.get_tensor(index)[0])
+        return [np.stack(output) for output in outputs]
+
+
+class OnnxBackend(Backend):
+    """Runs an ONNX model with ONNX Runtime's CPU execution provider.
+
+    Unlike TensorFlow's global thread pools, the threads of every session are
+    set precisely, which lets each worker process use its share of the CPUs.
+
+    ### Arguments
+    `model_path`: path of the ONNX model file.
+
+    `intra_op_threads`: the number of threads used to run a single operator.
+    If `None`, ONNX Runtime's default is used.
+
+    `inter_op_threads`: the number of threads used to run independent
+    operators in parallel. If `None`, ONNX Runtime's default is used.
+    """
+
+    def __init__(self, model_path: str, intra_op_threads: int = None,
+                 inter_op_threads: int = None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception("The onnx backend requires onnxruntime")
+        options = onnxruntime.SessionOptions()
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads is not None:
+            options.inter_op_num_threads = inter_op_threads
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        self.__session = onnxruntime.InferenceSession(
+            model_path, sess_options=options,
+            providers=["CPUExecutionProvider"])
+        self.__input_name = self.__session.get_inputs()[0].name
+        # models exported from TensorFlow name their outputs like tensors
+        # ("detection_boxes:0")
+        self.__session_output_names = [
+            output.name for output in self.__session.get_outputs()]
+        self.output_names = [name.split(":")[0]
+                             for name in self.__session_output_names]
+
+    def run(self, inputs: np.ndarray) -> list:
+        return self.__session.run(self.__session_output_names,
+                                  {self.__input_name: inputs})
+
+
+def convert_to_tflite(model, quantization: str = None,
+                      representative_inputs: np.ndarray = None) -> bytes:
+    """Converts the given Keras `model` to a TFLite flatbuffer.
+
+    ### Arguments
+    `quantization`: the post-training quantization; `float16`, `int8` or
+    `None` (no quantization).
+
+    `representative_inputs`: the inputs `int8` quantization is calibrated on,
+    an array with one row per input.
+    """
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if representative_inputs is None or not len(representative_inputs):
+            raise ValueError("int8 quantization requires representative inputs")
+        converter.representative_dataset = lambda: (
+            [single_input[np.newaxis]] for single_input in representative_inputs)
+    return converter.convert()
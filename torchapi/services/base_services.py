@@ -7,21 +7,29 @@ __author__ = "Emre Bicer; Omar Othman"
 
 
 from abc import ABC, abstractmethod
+import asyncio
 import os
-import random
+import threading
 import numpy as np
 
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing import image
-
-from .common import asset_file, temp_file, base64_to_image_obj
+from .backends import KerasBackend, OnnxBackend, TFLiteBackend, \
+    convert_to_tflite
+from .common import asset_file, atomic_write, base64_to_image_obj, \
+    hashed_asset_file
 from ..exceptions import TorchException
-from ..logger import log_e, log_i
+from ..executor import get_executor
+from ..logger import log_e, log_i, log_w
+
+# default images the int8 TFLite model is calibrated on (base-64 files in one
+# directory per class)
+_CALIBRATION_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "experiments", "bg_threshold",
+    "data", "base64")
 
-# alphanumeric population for random name generator
-_POPULATION = list(map(chr, list(range(48, 58)) +
-                       list(range(65, 91)) + list(range(97, 123))))
-_RANDOM_STRING_LENGTH = 64
+# the largest number of images run in a single forward pass; larger batches are
+# run in several passes, so that the input buffer of each thread stays small
+# (about 19 MB for 224x224 images)
+_MAX_FORWARD_BATCH = 32
 
 
 class Service(ABC):
@@ -41,8 +49,54 @@ class Service(ABC):
         confidence level is a number between 0 and 1.
         """
 
-    def get_random_name(self) -> str:
-        return "".join(random.choices(_POPULATION, k=_RANDOM_STRING_LENGTH))
+    def warmup(self):
+        """Prepares the service for its first request, e.g. by running its
+        model once. Does nothing by default.
+        """
+
+    async def predict_async(self, req: dict) -> (str, float):
+        """Coroutine version of `predict`.
+
+        The inference is run on the executor shared by the API (see
+        `executor.get_executor`), so it does not block the event loop and the
+        number of concurrent model calls stays bounded.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), self.predict, req)
+
+    def predict_batch(self, reqs: list) -> list:
+        """Runs inference on each of the given `reqs` (requests for this
+        service).
+
+        Returns a list with one item per request, in the same order: either the
+        `(prediction, confidence)` tuple that `predict` would return, or the
+        `TorchException` raised for that request. Model-backed services
+        override this to run a single forward pass for the whole batch.
+        """
+        results = []
+        for req in reqs:
+            try:
+                results.append(self.predict(req))
+            except TorchException as exception:
+                results.append(exception)
+        return results
+
+    def load_image_obj(self, req: dict, decode: bool = True):
+        """Returns the `ImageObject` of the given `req`uest, ensuring that its
+        image data can be decoded.
+
+        Request errors are raised as a `TorchException` originating from this
+        service. If `decode` is false, the image is not decoded; the caller
+        then decodes it itself and handles decoding errors.
+        """
+        try:
+            image_obj = base64_to_image_obj(req)
+            if decode:
+                # decoding here surfaces invalid image data as a request error
+                image_obj.pil
+            return image_obj
+        except TorchException as ex:
+            raise TorchException(self.service_name, str(ex))
 
 
 class KerasCnnImageService(Service):
@@ -58,8 +112,36 @@ class KerasCnnImageService(Service):
 
     `model_filename`: name of model file to load from the assets directory.
     Default is `model.h5`.
+
+    ### Configuration
+    `background_threshold`: the confidence (or list of confidences by class)
+    below which the predicted class is `bg`.
+
+    `backend`: the inference backend (see `backends`); `keras` (the default)
+    runs the Keras model, `tflite` runs it converted to TensorFlow Lite and
+    `onnx` runs the ONNX model `onnx_model` (default `model.onnx`) from the
+    assets with ONNX Runtime. The TFLite model is saved next to the Keras
+    model and only rebuilt when the latter changes.
+
+    `quantization`: the post-training quantization of the `tflite` model;
+    `float16`, `int8` or none (the default). `int8` is calibrated on the
+    images in `calibration_dir` (by default the background threshold
+    experiment data), at most `calibration_size` (default 100) of them.
+
+    `num_threads`: the number of threads the `tflite` interpreter uses.
+
+    `intra_op_threads`, `inter_op_threads`: the number of threads the `onnx`
+    session uses within and across operators.
+
+    `jpeg_draft`: whether JPEG images larger than the model input are decoded
+    at a reduced scale (see `ImageObject.resized`). This changes the model
+    input, so it is off by default.
     """
 
+    # supported inference backends and TFLite quantizations
+    BACKENDS = ("keras", "tflite", "onnx")
+    QUANTIZATIONS = (None, "float16", "int8")
+
     def __init__(self, service_name, config=None, class_map: dict = None,
                  model_filename: str = "model.h5"):
         super().__init__(service_name, config)
@@ -92,14 +174,124 @@ class KerasCnnImageService(Service):
         if invalid_threshold:
             raise ValueError(
                 "Background threshold must be between 0 (inclusive) and 1 (exclusive)")
+        # the threshold (or thresholds by class index) as an array to compare
+        # whole batches of confidences at once
+        self.__thresholds = np.asarray(self.background_threshold,
+                                       dtype=np.float64)
+        # class names by model output index; None for unmapped outputs
+        self.__class_names = None
+        if class_map:
+            self.__class_names = np.full(max(class_map) + 1, None,
+                                         dtype=object)
+            for result, prediction_class in class_map.items():
+                self.__class_names[result] = prediction_class
+
+        self.image_size = (224, 224)
+        # model input buffers, one per thread running batches
+        self.__buffers = threading.local()
+
+        config = self.config or {}
+        self.jpeg_draft = config.get("jpeg_draft", False)
+        self.backend_name = config.get("backend", "keras")
+        if self.backend_name not in self.BACKENDS:
+            raise ValueError(
+                f"Unknown backend '{self.backend_name}', must be one of "
+                f"{', '.join(self.BACKENDS)}")
+        self.quantization = config.get("quantization", None)
+        if self.quantization not in self.QUANTIZATIONS:
+            raise ValueError(
+                f"Unknown quantization '{self.quantization}', must be one of "
+                f"{', '.join(q for q in self.QUANTIZATIONS if q)}")
 
         try:
-            self.model = load_model(self.model_filename)
+            if self.backend_name == "tflite":
+                self.backend = self.__load_tflite(
+                    config.get("num_threads", None),
+                    config.get("calibration_dir", _CALIBRATION_DIR),
+                    config.get("calibration_size", 100))
+            elif self.backend_name == "onnx":
+                self.backend = OnnxBackend(
+                    asset_file(self.service_name,
+                               config.get("onnx_model", "model.onnx")),
+                    intra_op_threads=config.get("intra_op_threads", None),
+                    inter_op_threads=config.get("inter_op_threads", None))
+            else:
+                self.backend = KerasBackend(self.model_filename,
+                                            self.image_size + (3,))
             log_i(self.service_name, "Model loaded")
-        except:
-            log_e(self.service_name, "Could not load model")
+        except Exception as err:
+            log_e(self.service_name, f"Could not load model: {err}")
             raise Exception(f"Could not load model [{self.service_name}]")
-        self.image_size = (224, 224)
+
+    def warmup(self):
+        # run once so that the first request does not pay for setting up the
+        # inference (and the framework's thread pools)
+        self.backend.run(np.zeros((1,) + self.image_size + (3,),
+                                  dtype=np.float32))
+        log_i(self.service_name, f"Inference ready ({self.backend_name})")
+
+    def __load_tflite(self, num_threads: int, calibration_dir: str,
+                      calibration_size: int) -> TFLiteBackend:
+        """Loads the TFLite model with the configured quantization from the
+        assets, converting the Keras model first if it was not converted yet.
+        """
+        with open(self.model_filename, "rb") as model_file:
+            tflite_path = hashed_asset_file(
+                self.service_name, f"model_{self.quantization or 'float32'}",
+                model_file.read(), "tflite")
+        if os.path.exists(tflite_path):
+            return TFLiteBackend(model_path=tflite_path,
+                                 num_threads=num_threads)
+
+        log_i(self.service_name, "Converting model to TFLite")
+        representative_inputs = None
+        if self.quantization == "int8":
+            representative_inputs = self.__load_calibration_images(
+                calibration_dir, calibration_size)
+        tflite_model = convert_to_tflite(
+            KerasBackend(self.model_filename, self.image_size + (3,)).model,
+            self.quantization, representative_inputs)
+        try:
+            atomic_write(tflite_path,
+                         lambda tflite_file: tflite_file.write(tflite_model))
+        except OSError as err:
+            log_w(self.service_name, f"Could not save TFLite model: {err}")
+        return TFLiteBackend(model_content=tflite_model,
+                             num_threads=num_threads)
+
+    def __load_calibration_images(self, calibration_dir: str,
+                                  calibration_size: int) -> np.ndarray:
+        """Loads up to `calibration_size` base-64 images from the given
+        directory (one subdirectory per class) as a model input tensor."""
+        if not os.path.isdir(calibration_dir):
+            raise Exception(
+                f"No calibration data for int8 quantization [{self.service_name}]")
+        class_files = []
+        for class_name in sorted(os.listdir(calibration_dir)):
+            class_path = os.path.join(calibration_dir, class_name)
+            if os.path.isdir(class_path):
+                class_files.append([os.path.join(class_path, filename)
+                                    for filename in sorted(os.listdir(class_path))])
+        # the same number of images from every class
+        per_class = -(-calibration_size // max(len(class_files), 1))
+        paths = [path for files in class_files for path in files[:per_class]]
+
+        paths = paths[:calibration_size]
+        images = np.empty((len(paths),) + self.image_size + (3,),
+                          dtype=np.float32)
+        count = 0
+        for path in paths:
+            with open(path, "r") as base64_file:
+                req = {"image": base64_file.read().strip()}
+            try:
+                self.__load_request_image(req, images[count])
+                count += 1
+            except TorchException as ex:
+                log_w(self.service_name, f"Skipped calibration image {path}: {ex}")
+        if not count:
+            raise Exception(
+                f"No calibration data for int8 quantization [{self.service_name}]")
+        return images[:count]
 
     def predict(self, req: dict) -> (str, float):
         """Runs inference on the image in the given `req`uest.
@@ -112,59 +304,94 @@ class KerasCnnImageService(Service):
         corresponds to the predicted class's activation node in the model's last
         layer.
         """
-        # The base-64 string is converted into an image object but this object
-        # cannot be passed to Keras directly. The object is first dumped into a
-        # temp file and then the filename is passed to Keras.
+        result = self.predict_batch([req])[0]
+        if isinstance(result, TorchException):
+            raise result
+        return result
+
+    def predict_batch(self, reqs: list) -> list:
+        """Runs inference on the images of all the given `reqs` in as few
+        forward passes of the model as possible (one per `_MAX_FORWARD_BATCH`
+        images).
+
+        See `Service.predict_batch` for the format of the returned list.
+        """
+        results = [None] * len(reqs)
+        batch = self.__batch_buffer(min(len(reqs), _MAX_FORWARD_BATCH))
+        indexes = []
+        for index, req in enumerate(reqs):
+            try:
+                # images that load fill the batch one after the other
+                self.__load_request_image(req, batch[len(indexes)])
+                indexes.append(index)
+            except TorchException as exception:
+                results[index] = exception
+            if len(indexes) == len(batch):
+                self.__run_batch(batch, indexes, results)
+                indexes = []
+        if indexes:
+            self.__run_batch(batch, indexes, results)
+        return results
+
+    def __run_batch(self, batch: np.ndarray, indexes: list, results: list):
+        """Runs the model on the first images of the `batch`, which are those
+        of the requests at the given `indexes`, and stores their results."""
+        # Get a value between 0 and 1 for each class (one row per image)
+        pred = self.backend.run(batch[:len(indexes)])[0]
+        for index, result in zip(indexes, self.__interpret_batch(pred)):
+            results[index] = result
+
+    def __load_request_image(self, req: dict, out: np.ndarray):
+        """Loads the image in the given `req`uest resized to the model input
+        size into `out`, a float32 array of shape (height, width, channels),
+        with its pixel values mapped between 0 and 1.
+        """
+        image_obj = self.load_image_obj(req, decode=False)
         try:
-            image_obj = base64_to_image_obj(req)
+            # large JPEG images are decoded straight at a reduced size
+            img = image_obj.resized(self.image_size, draft=self.jpeg_draft)
         except TorchException as ex:
-            raise TorchException(str(ex), self.service_name)
-        random_file_name = super().get_random_name()
-        temp_image_filename = temp_file(self.service_name, random_file_name)
-        with open(temp_image_filename, "wb") as img_file:
-            img_file.write(image_obj)
-        try:
-            temp_image = self.__load_image(temp_image_filename)
-        except:
-            raise TorchException(
-                "Could not load image data", self.service_name)
-        # Get a value between 0 and 1 for each class (pred is a list in a list)
-        pred = self.model.predict(temp_image)
-        # Get the index of the highest prediction
-        result = np.argmax(pred, axis=1)
+            raise TorchException(self.service_name, str(ex))
+        # the division writes straight into the batch, without an
+        # intermediate float copy of the image
+        np.divide(img, np.float32(255.), out=out)
+
+    def __batch_buffer(self, size: int) -> np.ndarray:
+        """Returns a model input buffer of shape (at least `size`, height,
+        width, channels), reused by the later batches of the calling thread.
+        `size` is at most `_MAX_FORWARD_BATCH`, which bounds the buffer.
+        """
+        buffer = getattr(self.__buffers, "batch", None)
+        if buffer is None or len(buffer) < size:
+            buffer = np.empty((size,) + self.image_size + (3,),
+                              dtype=np.float32)
+            self.__buffers.batch = buffer
+        return buffer
+
+    def __interpret_batch(self, pred) -> list:
+        """Maps the model output (one row per image) to the predicted class
+        and its confidence for each image, applying the background threshold.
+        """
+        # Get the index of the highest prediction of each image
+        results = np.argmax(pred, axis=1)
+        confidences = pred[np.arange(len(pred)), results]
         if self.class_map:
-            prediction_class = self.class_map.get(result[0], None)
-            if not prediction_class:
+            if np.any(results >= len(self.__class_names)) or \
+                    not all(self.__class_names[results]):
                 raise Exception(
-                    "Unexpected class from model [{self.service_name}]")
+                    f"Unexpected class from model [{self.service_name}]")
+            prediction_classes = self.__class_names[results]
         else:
-            prediction_class = result[0]
-        os.remove(temp_image_filename)
-
-        confidence = float(pred[0][result[0]])
-        # Compare the confidence with either the single-value threshold or the
-        # corresponding class threshold if threshold is a provided as a list.
-        if (isinstance(self.background_threshold, float) and
-                confidence < self.background_threshold) \
-                or (isinstance(self.background_threshold, list) and
-                    confidence < self.background_threshold[result[0]]):
-            prediction_class = 'bg'
+            prediction_classes = results
 
-        # Always return a string class
-        return str(prediction_class), confidence
+        # Compare the confidences with either the single-value threshold or the
+        # corresponding class thresholds if threshold is a provided as a list.
+        thresholds = self.__thresholds[results] if self.__thresholds.ndim \
+            else self.__thresholds
+        background = confidences < thresholds
 
-    def __load_image(self, img_path):
-        """
-            Resize the image and map the pixel values between 0 and 1
-        """
-        # Load the image with given size
-        img = image.load_img(img_path, target_size=self.image_size)
-        # convert the image into array format (height, width, channels)
-        img_tensor = image.img_to_array(img)
-        # add a dimension because the model expects this shape: (batch_size,
-        # height, width, channels)
-        img_tensor = np.expand_dims(img_tensor, axis=0)
-        # imshow expects values in the range [0, 1]
-        img_tensor /= 255.
-
-        return img_tensor
+        # Always return a string class
+        return [('bg' if is_background else str(prediction_class),
+                 float(confidence))
+                for prediction_class, confidence, is_background
+                in zip(prediction_classes, confidences, background)]
@@ -3,23 +3,58 @@
 
 __author__ = "Ezgi Nur Ucay"
 
-from .base_services import Service
-from .common import base64_to_image_obj, temp_file, asset_file
-from .assets.color_detection.utils.knn_classifier import classify
-from .assets.color_detection.utils.color_feature_extraction import histogram_of_test_image
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from ..exceptions import TorchException
+from .base_services import Service
+from .assets.color_detection.utils.knn_classifier import ColorKnnModel
+from .assets.color_detection.utils.color_feature_extraction import FEATURE_MODES
+from .assets.color_detection.utils.color_feature_extraction import feature_length
+from .assets.color_detection.utils.color_feature_extraction import features_of_frames
+from .assets.color_detection.utils.color_feature_extraction import histogram_of_image_file
 from .object_detection import ObjectDetectionService
-import os
-import cv2
 
 class ColorDetectionService(Service):
     """A service for detecting color of object.
+
+    ### Configuration
+    `features`: the color feature that is classified; one of `peak` (the peak
+    values of the r, g, b histograms, the default), `hsv` (hue/saturation/value
+    histogram) or `quantized` (color histogram). The training file only holds
+    peak colors, so `hsv` and `quantized` are trained from labelled images
+    (see `import_training_data`) and cannot predict until they are.
+
+    `bins`: the number of histogram bins per channel of the `hsv` and
+    `quantized` features. Default is 4.
     """
 
-    def __init__(self, object_detection: ObjectDetectionService):
+    def __init__(self, object_detection: ObjectDetectionService, config=None):
         service_name = "color"
         self.frame = object_detection
-        super().__init__(service_name)
+        super().__init__(service_name, config)
+
+        config = self.config or {}
+        self.features = config.get("features", "peak")
+        if self.features not in FEATURE_MODES:
+            raise ValueError(
+                f"Unknown color feature '{self.features}', must be one of "
+                f"{', '.join(FEATURE_MODES)}")
+        self.bins = config.get("bins", 4)
+        if not 1 <= self.bins <= 256:
+            raise ValueError("Histogram bins must be between 1 and 256")
+
+        # the training set is loaded once for the lifetime of the service;
+        # samples added later are kept in a store of the feature mode. The
+        # histograms of solid color swatches of the training file do not tell
+        # its colors apart (e.g. black, gray and white have the same hue and
+        # saturation), so the histogram modes only use their store.
+        if self.features == 'peak':
+            self.knn = ColorKnnModel('training.data', store_name='samples')
+        else:
+            self.knn = ColorKnnModel(
+                None, store_name=f'samples_{self.features}_{self.bins}',
+                feature_length=feature_length(self.features, self.bins))
 
     def predict(self, req: dict) -> str:
         """
@@ -34,39 +69,73 @@ class ColorDetectionService(Service):
         returned with the prediction value.
         """
 
-        try:
-            image_obj = base64_to_image_obj(req)
-        except TorchException as ex:
-            raise TorchException(msg=str(ex), origin=self.service_name)
-
-        random_file_name = super().get_random_name()
-        temp_image_filename = temp_file(self.service_name, random_file_name)
+        if not self.knn.trained:
+            raise TorchException(
+                self.service_name,
+                f"The {self.features} color feature has no training data")
 
-        with open(temp_image_filename, "wb") as img_file:
-            img_file.write(image_obj)
+        # the image is decoded once and shared by object detection and the
+        # histograms
+        image_obj = self.load_image_obj(req)
+        image_rgb = image_obj.rgb
 
-        objects = self.frame.get_objects_with_frames(temp_image_filename)
-        prediction = ''
+        objects = self.frame.get_objects_with_frames(image_rgb)
 
         try:
             if not objects:
-                histogram_of_test_image(temp_image_filename)
-                prediction += str(classify('training.data','test.data'))
+                features = features_of_frames(
+                    image_rgb, [None], self.features, self.bins,
+                    channel_order='rgb')
+                prediction = str(self.knn.classify(features)[0])
             else:
                 frames = list(map(lambda x: x['frames'], objects))
                 object_names = list(map(lambda x: x['object_name'], objects))
 
-                for i in range(len(frames)):
-                    histogram_of_test_image(temp_image_filename, frames[i])
-                    prediction += str(classify('training.data', 'test.data'))+' '+str(object_names[i])
-                    if i != len(frames) - 1:
-                        prediction+=','
+                # the features of all frames are classified in one batch
+                features = features_of_frames(
+                    image_rgb, frames, self.features, self.bins,
+                    channel_order='rgb')
+                colors = self.knn.classify(features)
+                prediction = ','.join(
+                    str(color)+' '+str(object_name)
+                    for color, object_name in zip(colors, object_names))
 
-            os.remove(temp_image_filename)
             return str(prediction), 1
 
         except:
             raise Exception("Could not detect color")
 
-    def add_training_data(img_path, img_tag):
-        add_training_histogram(img_path, img_tag)
+    def add_training_data(self, img_path: str, img_tag: str):
+        """Adds the color of the image at the given path to the training set
+        with the given tag (color name). The sample is used by the next
+        prediction and kept for future instances of the service.
+        """
+        self.knn.add_samples(
+            [histogram_of_image_file(img_path, self.features, self.bins)],
+            [img_tag])
+
+    def import_training_data(self, directory: str, max_workers: int = None) -> int:
+        """Adds all the images in the given directory to the training set.
+
+        The images are expected in one subdirectory per tag (color name), i.e.
+        `<directory>/<tag>/<image>`. Their histograms are computed in parallel
+        and added in a single step. Returns the number of added samples.
+        """
+        paths = []
+        tags = []
+        for tag in sorted(os.listdir(directory)):
+            tag_path = os.path.join(directory, tag)
+            if not os.path.isdir(tag_path):
+                continue
+            for filename in sorted(os.listdir(tag_path)):
+                paths.append(os.path.join(tag_path, filename))
+                tags.append(tag)
+
+        # OpenCV releases the GIL while decoding, so threads run in parallel
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            features = list(executor.map(
+                lambda image_path: histogram_of_image_file(
+                    image_path, self.features, self.bins), paths))
+        self.knn.add_samples(features, tags)
+        return len(features)
+
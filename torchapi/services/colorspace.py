@@ -0,0 +1,102 @@
+"""Color space functions
+
+Vectorized conversions between color spaces and perceptual color differences.
+All functions accept arrays whose last axis holds the color channels and
+broadcast over the other axes.
+"""
+
+__author__ = "Emre Biçer"
+
+
+import numpy as np
+
+# sRGB (D65) to CIE XYZ
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+# D65 reference white
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+# CIE standard constants
+_EPSILON = 216 / 24389
+_KAPPA = 24389 / 27
+
+
+def rgb_to_lab(rgb) -> np.ndarray:
+    """Converts sRGB colors (channel values between 0 and 255) to CIELAB."""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    # undo the sRGB gamma
+    linear = np.where(rgb <= 0.04045, rgb / 12.92,
+                      ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > _EPSILON, np.cbrt(xyz), (_KAPPA * xyz + 16) / 116)
+    f_x, f_y, f_z = f[..., 0], f[..., 1], f[..., 2]
+    return np.stack([116 * f_y - 16,
+                     500 * (f_x - f_y),
+                     200 * (f_y - f_z)], axis=-1)
+
+
+def delta_e_76(lab1, lab2) -> np.ndarray:
+    """Returns the CIE76 color difference (euclidean distance in CIELAB)
+    between the given CIELAB colors."""
+    diff = np.asarray(lab1, dtype=np.float64) - np.asarray(lab2,
+                                                            dtype=np.float64)
+    return np.sqrt((diff ** 2).sum(axis=-1))
+
+
+def delta_e_2000(lab1, lab2) -> np.ndarray:
+    """Returns the CIEDE2000 color difference between the given CIELAB colors.
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    l_1, a_1, b_1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    l_2, a_2, b_2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    # chroma-dependent correction of a*
+    c_mean = (np.hypot(a_1, b_1) + np.hypot(a_2, b_2)) / 2
+    c_mean_7 = c_mean ** 7
+    g = 0.5 * (1 - np.sqrt(c_mean_7 / (c_mean_7 + 25 ** 7)))
+    a_1 = (1 + g) * a_1
+    a_2 = (1 + g) * a_2
+
+    c_1 = np.hypot(a_1, b_1)
+    c_2 = np.hypot(a_2, b_2)
+    h_1 = np.degrees(np.arctan2(b_1, a_1)) % 360
+    h_2 = np.degrees(np.arctan2(b_2, a_2)) % 360
+    chroma_product = c_1 * c_2
+
+    # differences in lightness, chroma and hue
+    delta_l = l_2 - l_1
+    delta_c = c_2 - c_1
+    delta_h = h_2 - h_1
+    delta_h = np.where(delta_h > 180, delta_h - 360, delta_h)
+    delta_h = np.where(delta_h < -180, delta_h + 360, delta_h)
+    delta_h = np.where(chroma_product == 0, 0, delta_h)
+    delta_h = 2 * np.sqrt(chroma_product) * np.sin(np.radians(delta_h / 2))
+
+    # means of lightness, chroma and hue
+    l_mean = (l_1 + l_2) / 2
+    c_mean = (c_1 + c_2) / 2
+    h_sum = h_1 + h_2
+    h_mean = np.where(np.abs(h_1 - h_2) <= 180, h_sum / 2,
+                      np.where(h_sum < 360, (h_sum + 360) / 2,
+                               (h_sum - 360) / 2))
+    h_mean = np.where(chroma_product == 0, h_sum, h_mean)
+
+    # weighting functions
+    t = (1 - 0.17 * np.cos(np.radians(h_mean - 30))
+         + 0.24 * np.cos(np.radians(2 * h_mean))
+         + 0.32 * np.cos(np.radians(3 * h_mean + 6))
+         - 0.20 * np.cos(np.radians(4 * h_mean - 63)))
+    delta_theta = 30 * np.exp(-((h_mean - 275) / 25) ** 2)
+    c_mean_7 = c_mean ** 7
+    r_c = 2 * np.sqrt(c_mean_7 / (c_mean_7 + 25 ** 7))
+    s_l = 1 + (0.015 * (l_mean - 50) ** 2) / np.sqrt(20 + (l_mean - 50) ** 2)
+    s_c = 1 + 0.045 * c_mean
+    s_h = 1 + 0.015 * c_mean * t
+    r_t = -np.sin(np.radians(2 * delta_theta)) * r_c
+
+    term_l = delta_l / s_l
+    term_c = delta_c / s_c
+    term_h = delta_h / s_h
+    return np.sqrt(term_l ** 2 + term_c ** 2 + term_h ** 2
+                   + r_t * term_c * term_h)
@@ -8,17 +8,27 @@ __author__ = "Omar Othman"
 
 
 import base64
+import binascii
+import hashlib
+import io
 import os
 import re
+import threading
 
 from pathlib import Path
 
+import cv2
+import numpy as np
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
 from ..exceptions import TorchException
 
 _LOCAL_PATH = os.path.dirname(__file__)
 
 _ASSETS_DIR = os.path.join(_LOCAL_PATH, "assets")
-_TEMP_DIR = os.path.join(_LOCAL_PATH, "temp")
 
 
 def _file(base_dir: str, svc: str, filename: str) -> str:
@@ -38,28 +48,239 @@ def asset_file(svc: str, filename: str) -> str:
     return _file(_ASSETS_DIR, svc, filename)
 
 
-def temp_file(svc: str, filename: str) -> str:
-    """Returns a full path for a temp file for the given service (`svc`) and
-    with the given `filename`. Ensures that the directory to that file exists.
+def hashed_asset_file(svc: str, name: str, source: bytes, extension: str) -> str:
+    """Returns the path of an asset file (see `asset_file`) derived from the
+    given `source` data, e.g. a model converted from another model file.
 
-    Temp files are saved to the directory `temp` in the same location where
-    this function is defined, with each `svc` in its own subdirectory.
+    The file is named `<name>_<hash>.<extension>`, with a short hash of
+    `source`, so that files derived from another version of the source data
+    are never loaded.
     """
-    return _file(_TEMP_DIR, svc, filename)
+    source_hash = hashlib.sha1(source).hexdigest()[:12]
+    return asset_file(svc, f"{name}_{source_hash}.{extension}")
+
+
+def atomic_write(path: str, write_fn):
+    """Writes the file at the given `path` by calling `write_fn` with a binary
+    file object.
+
+    The data is written to a temporary file first, which is then moved in
+    place, so that other threads and processes never read a partially written
+    file. The temporary file is removed if writing fails.
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as temp_file:
+            write_fn(temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+# key under which the image object of a request is kept in the request itself
+_IMAGE_OBJ_KEY = "_image_obj"
+
+# header of the data URL of a base-64 image
+_DATA_URL_HEADER = re.compile(r"data:image(/[^,\n]*)?;base64,")
+
+
+class ImageObject:
+    """The image of a single request, decoded lazily and at most once.
+
+    All decoded views are memoized on first access and shared by everything
+    that handles the same request, so they must not be modified in place.
+
+    ### Arguments
+    `data`: the encoded image file contents (e.g. PNG or JPEG bytes).
+    """
+
+    # quantization levels of each channel of `color_signature`
+    COLOR_SIGNATURE_LEVELS = 8
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self._pil = None
+        self._rgb = None
+        self._gray = None
+        self._resized = {}
+        self._digest = None
+        self._dhash = None
+        self._color_signature = None
+        self._thumbnail = None
 
+    @property
+    def digest(self) -> bytes:
+        """A hash of the encoded image data, identifying identical images."""
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self.data, digest_size=16).digest()
+        return self._digest
 
-def base64_to_image_obj(req: dict):
+    @property
+    def dhash(self) -> int:
+        """A 64-bit perceptual (difference) hash of the image. Images that look
+        alike have hashes with a small Hamming distance, even if their bytes
+        differ (e.g. because of JPEG noise).
+
+        The hash only describes the brightness gradients of the image, so
+        images that differ mostly by color (e.g. banknotes of different
+        denominations) may have near hashes; see `color_signature`."""
+        if self._dhash is None:
+            gray = cv2.cvtColor(self.__thumbnail(), cv2.COLOR_RGB2GRAY)
+            # compare horizontally adjacent pixels of a 9x8 thumbnail
+            thumbnail = cv2.resize(gray, (9, 8),
+                                   interpolation=cv2.INTER_AREA)
+            bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+            self._dhash = int.from_bytes(np.packbits(bits).tobytes(), "big")
+        return self._dhash
+
+    @property
+    def color_signature(self) -> tuple:
+        """A coarse signature of the colors of the image: its mean R, G and B
+        values, each quantized to one of `COLOR_SIGNATURE_LEVELS` levels.
+        Images that look alike but differ in color have different
+        signatures."""
+        if self._color_signature is None:
+            mean = self.__thumbnail().reshape(-1, 3).mean(axis=0)
+            step = 256 / self.COLOR_SIGNATURE_LEVELS
+            self._color_signature = tuple(int(value // step)
+                                          for value in mean)
+        return self._color_signature
+
+    def __thumbnail(self):
+        """The image as a small (but at least 64x64) RGB array if it is a
+        JPEG, or the full RGB array otherwise. JPEG images are always decoded
+        at a reduced size for it, so that the hashes of an image never depend
+        on what else was decoded from it."""
+        if self._thumbnail is None:
+            thumbnail = self.__open_draft("RGB", (64, 64))
+            self._thumbnail = self.rgb if thumbnail is None \
+                else self.__freeze(np.asarray(thumbnail))
+        return self._thumbnail
+
+    @property
+    def pil(self):
+        """The decoded image as an RGB PIL image."""
+        if self._pil is None:
+            try:
+                self._pil = Image.open(io.BytesIO(self.data)).convert("RGB")
+            except (OSError, ValueError):
+                raise TorchException("request", "Could not load image data")
+        return self._pil
+
+    @property
+    def rgb(self):
+        """The decoded image as a uint8 array of shape (height, width, 3) in
+        RGB order."""
+        if self._rgb is None:
+            self._rgb = self.__freeze(np.asarray(self.pil))
+        return self._rgb
+
+    @property
+    def bgr(self):
+        """A view of `rgb` in BGR order, as OpenCV expects it."""
+        return self.rgb[..., ::-1]
+
+    @property
+    def gray(self):
+        """The decoded image as a uint8 grayscale array of shape (height,
+        width)."""
+        if self._gray is None:
+            self._gray = self.__freeze(
+                cv2.cvtColor(self.rgb, cv2.COLOR_RGB2GRAY))
+        return self._gray
+
+    def resized(self, size: tuple, resample=Image.NEAREST, draft=False):
+        """The decoded image resized to the given `size` (height, width) as a
+        uint8 RGB array. The default `resample` filter is the same as that of
+        Keras' `load_img`.
+
+        If `draft` is true and the image is a JPEG larger than `size`, it is
+        decoded at a reduced scale (still at least `size`) straight from the
+        encoded data, which is much faster than decoding it fully. The pixels
+        then differ slightly from those resized from the full image.
+        """
+        key = (tuple(size), resample, draft)
+        if key not in self._resized:
+            img = None
+            if draft and self._pil is None:
+                img = self.__open_draft("RGB", (size[1], size[0]))
+            if img is None:
+                img = self.pil
+            # PIL expects the size as (width, height)
+            img = img.resize((size[1], size[0]), resample)
+            self._resized[key] = self.__freeze(np.asarray(img))
+        return self._resized[key]
+
+    def draft(self, size: tuple):
+        """The decoded image as a uint8 RGB array of shape (height, width, 3),
+        at least `size` (height, width) if it is that large.
+
+        JPEG images are decoded at the smallest reduced scale (1/2, 1/4 or 1/8)
+        that is still at least `size`, straight from the encoded data, which is
+        much faster than decoding them fully; their pixels then differ
+        slightly from those of `rgb`. Other images (and images already decoded
+        fully) are returned as `rgb`.
+        """
+        key = ("draft", tuple(size))
+        if key not in self._resized:
+            img = None
+            if self._pil is None:
+                img = self.__open_draft("RGB", (size[1], size[0]))
+            self._resized[key] = self.rgb if img is None \
+                else self.__freeze(np.asarray(img))
+        return self._resized[key]
+
+    def __open_draft(self, mode: str, size: tuple):
+        """Decodes the image in the given `mode` at the smallest scale that is
+        at least `size` (width, height), if it is a JPEG. Returns `None` for
+        other formats."""
+        try:
+            img = Image.open(io.BytesIO(self.data))
+            if img.format != "JPEG":
+                return None
+            img.draft(mode, size)
+            return img.convert(mode)
+        except (OSError, ValueError):
+            raise TorchException("request", "Could not load image data")
+
+    @staticmethod
+    def __freeze(array):
+        array.setflags(write=False)
+        return array
+
+
+def base64_to_image_obj(req: dict) -> ImageObject:
     """Extracts the base-64 image string from the given `req`uest and converts
-    it to a bytes object. This bytes object can then be written (in binary mode)
-    to an image file.
+    it to an `ImageObject`, which decodes the image lazily.
+
+    The image object is created once per request and kept in the request, so
+    every later call for the same `req` returns the same object.
     """
+    image_obj = req.get(_IMAGE_OBJ_KEY, None)
+    if image_obj is not None:
+        return image_obj
     image_base64 = req.get("image", None)
     if not image_base64:
-        raise TorchException("No image")
-    encoding_regex = re.search(
-        r"^data:image(/(.*))?;base64,(.+)$", image_base64)
-    if not encoding_regex:
-        raise TorchException("Invalid image format")
-    encoding = encoding_regex.group(3)
-    image = base64.b64decode(encoding)
-    return image
+        raise TorchException("request", "No image")
+    if not isinstance(image_base64, str):
+        raise TorchException("request", "Invalid image format")
+    # only the header is matched; a pattern spanning the whole (possibly
+    # multi-megabyte) string costs more than decoding it
+    header = _DATA_URL_HEADER.match(image_base64)
+    if not header:
+        raise TorchException("request", "Invalid image format")
+    encoding = image_base64[header.end():]
+    if encoding.endswith("\n"):
+        encoding = encoding[:-1]
+    if not encoding or "\n" in encoding:
+        raise TorchException("request", "Invalid image format")
+    try:
+        image_obj = ImageObject(base64.b64decode(encoding, validate=True))
+    except binascii.Error:
+        raise TorchException("request", "Invalid image format")
+    req[_IMAGE_OBJ_KEY] = image_obj
+    return image_obj
@@ -4,82 +4,304 @@
 __author__ = "Emre Biçer"
 
 
-import math
 import os
-import sys
 
-import cv2
 import numpy
 
 from ..exceptions import TorchException
-from ..logger import log_e
+from ..logger import log_e, log_i, log_w
 from .base_services import Service
-from .common import asset_file, base64_to_image_obj, temp_file
+from .colorspace import delta_e_2000, delta_e_76, rgb_to_lab
+from .common import asset_file, atomic_write, hashed_asset_file
+
+# distance functions of the supported color spaces; they take colors already
+# converted to the space (see `_TO_SPACE`)
+_DISTANCES = {
+    # squared euclidean distance; the square root does not change the order
+    "rgb": lambda colors, palette: ((colors - palette) ** 2).sum(axis=-1),
+    "cie76": delta_e_76,
+    "ciede2000": delta_e_2000,
+}
+
+# conversions of RGB colors to the space their distance is measured in
+_TO_SPACE = {
+    "rgb": lambda colors: numpy.asarray(colors, dtype=numpy.float64),
+    "cie76": rgb_to_lab,
+    "ciede2000": rgb_to_lab,
+}
 
 
 class DetailedColor(Service):
     """A service for detecting color on  the image
+
+    The color palette is loaded once, when the service is created, and the
+    average color of the image is matched to its nearest palette color.
+
+    ### Configuration
+    `distance`: the color difference used for matching; one of `rgb`
+    (euclidean distance in RGB, the default), `cie76` (CIE76, euclidean
+    distance in CIELAB) or `ciede2000` (CIEDE2000). The palette is converted
+    to the color space once.
+
+    `lut_bits`: if given, a lookup table holding the nearest palette color of
+    every color quantized to this many bits per channel (e.g. 5 gives a
+    32x32x32 table) is used to match colors with a single lookup, whatever the
+    `distance`. The match is then approximate (exact up to the quantization
+    step). The table is saved next to the color dataset and only rebuilt when
+    the dataset changes.
+
+    `sample_size`: if given, the colors are computed on a strided view of the
+    image with at most this many pixels along each side, instead of on every
+    pixel. Large JPEG images are then decoded at a reduced scale, so the
+    colors (and rarely the names) differ slightly from those of the full
+    image.
+
+    `center_crop`: the fraction (between 0 and 1) of the image's width and
+    height, around its center, that the colors are computed on. Default is 1
+    (the whole image).
+
+    ### Request options
+    `colors`: if given and greater than 1, up to this many dominant colors of
+    the image (found with k-means) are returned as a list of `color` names and
+    their `weight` (fraction of the pixels), instead of only the name of the
+    average color.
     """
 
-    def __init__(self):
+    DATASET_FILE = 'detailed_color_dataset.txt'
+
+    # number of colors matched at once when building the lookup table
+    _LUT_CHUNK_SIZE = 4096
+
+    # maximum number of dominant colors that can be requested
+    MAX_COLORS = 10
+
+    # mini-batch k-means parameters
+    _KMEANS_BATCH_SIZE = 1024
+    _KMEANS_ITERATIONS = 20
+
+    def __init__(self, config=None):
         service_name = "detailed_color"
-        super().__init__(service_name)
+        super().__init__(service_name, config)
 
-    def predict(self, req: dict) -> str:
+        config = self.config or {}
+        self.distance = config.get("distance", "rgb")
+        if self.distance not in _DISTANCES:
+            raise ValueError(
+                f"Unknown color distance '{self.distance}', must be one of "
+                f"{', '.join(_DISTANCES)}")
+        self.lut_bits = config.get("lut_bits", 0)
+        if not 0 <= self.lut_bits <= 8:
+            raise ValueError("Lookup table bits must be between 0 and 8")
+        self.sample_size = config.get("sample_size", 0)
+        if self.sample_size < 0:
+            raise ValueError("Sample size cannot be negative")
+        self.center_crop = config.get("center_crop", 1.0)
+        if not 0 < self.center_crop <= 1:
+            raise ValueError("Center crop must be between 0 (exclusive) and 1")
+
+        self.palette, self.color_names = self.load_palette()
+        # the palette in the color space of the distance
+        self.palette_space = _TO_SPACE[self.distance](self.palette)
+        self.lut = self.load_lut(self.lut_bits) if self.lut_bits else None
+
+    def load_palette(self) -> (numpy.ndarray, list):
+        """
+            Reads the color dataset and returns its colors as an
+            (n, 3) RGB array and their names as a list
+        """
+        data_set_path = asset_file(self.service_name, self.DATASET_FILE)
+        colors = []
+        names = []
+        with open(data_set_path) as data_set:
+            for line in data_set:
+                cur_r, cur_g, cur_b, cur_color = line.split(',')
+                colors.append((int(cur_r), int(cur_g), int(cur_b)))
+                names.append(cur_color.replace('\n', ''))
+        log_i(self.service_name, f"Loaded {len(names)} colors")
+        return numpy.array(colors, dtype=numpy.float64), names
 
-        # Convert base64 string to an image object
+    def nearest_colors(self, colors) -> numpy.ndarray:
+        """
+            Returns the palette index of the nearest color (by the
+            configured distance) to each of the given RGB `colors`,
+            an array of shape (m, 3)
+        """
+        colors = _TO_SPACE[self.distance](colors)
+        # distances of shape (m, n)
+        distances = _DISTANCES[self.distance](
+            colors[:, numpy.newaxis, :],
+            self.palette_space[numpy.newaxis, :, :])
+        return numpy.argmin(distances, axis=1)
+
+    def load_lut(self, bits: int) -> numpy.ndarray:
+        """
+            Loads the lookup table of the configured distance with
+            the given `bits` from the assets, building (and saving)
+            it if it does not exist yet
+        """
+        # tables built for another version of the dataset are not loaded
+        lut_path = hashed_asset_file(
+            self.service_name, f"lut_{self.distance}_{bits}",
+            self.palette.tobytes() +
+            '\n'.join(self.color_names).encode('utf-8'), "npy")
+        if os.path.exists(lut_path):
+            return numpy.load(lut_path)
+        lut = self.build_lut(bits)
         try:
-            image_obj = base64_to_image_obj(req)
+            atomic_write(lut_path, lambda lut_file: numpy.save(lut_file, lut))
+        except OSError as err:
+            log_w(self.service_name, f"Could not save lookup table: {err}")
+        return lut
+
+    def build_lut(self, bits: int) -> numpy.ndarray:
+        """
+            Builds a lookup table of shape (2^bits, 2^bits, 2^bits)
+            holding the palette index of the nearest color to the
+            center of each quantized RGB cell
+        """
+        levels = 1 << bits
+        step = 256 / levels
+        centers = (numpy.arange(levels) + 0.5) * step
+        grid = numpy.stack(numpy.meshgrid(centers, centers, centers,
+                                          indexing='ij'), axis=-1)
+        grid = grid.reshape(-1, 3)
+        lut = numpy.empty(len(grid), dtype=numpy.uint16)
+        for start in range(0, len(grid), self._LUT_CHUNK_SIZE):
+            end = start + self._LUT_CHUNK_SIZE
+            lut[start:end] = self.nearest_colors(grid[start:end])
+        log_i(self.service_name,
+              f"Built {levels}x{levels}x{levels} {self.distance} lookup table")
+        return lut.reshape(levels, levels, levels)
+
+    def match(self, color) -> str:
+        """
+            Returns the name of the palette color nearest to the
+            given RGB `color`
+        """
+        if self.lut is not None:
+            shift = 8 - self.lut_bits
+            r, g, b = (numpy.clip(numpy.asarray(color), 0, 255)
+                       .astype(numpy.uint8) >> shift)
+            index = self.lut[r, g, b]
+        else:
+            index = self.nearest_colors([color])[0]
+        return self.color_names[index]
+
+    def sample(self, img) -> numpy.ndarray:
+        """
+            Returns a view of the given image array cropped around
+            its center and strided down to the configured sizes
+        """
+        height, width = img.shape[:2]
+        if self.center_crop < 1:
+            crop_height = max(1, int(round(height * self.center_crop)))
+            crop_width = max(1, int(round(width * self.center_crop)))
+            top = (height - crop_height) // 2
+            left = (width - crop_width) // 2
+            img = img[top:top + crop_height, left:left + crop_width]
+            height, width = crop_height, crop_width
+        if self.sample_size:
+            stride = -(-max(height, width) // self.sample_size)
+            img = img[::stride, ::stride]
+        return img
+
+    def load_image(self, req: dict) -> numpy.ndarray:
+        """
+            Returns the image of the given `req`uest as an RGB
+            array. If the image is sampled, large JPEG images are
+            decoded at a reduced scale that still has at least
+            `sample_size` pixels per side of the cropped image
+        """
+        image_obj = self.load_image_obj(req, decode=False)
+        try:
+            if not self.sample_size:
+                return image_obj.rgb
+            side = int(numpy.ceil(self.sample_size / self.center_crop))
+            return image_obj.draft((side, side))
         except TorchException as ex:
-            raise TorchException(msg=str(ex), origin=self.service_name)
+            raise TorchException(self.service_name, str(ex))
+
+    def dominant_colors(self, pixels, k: int) -> list:
+        """
+            Clusters the given RGB `pixels`, an array of shape
+            (n, 3), into `k` colors using mini-batch k-means.
+            Returns a list of (color, weight) tuples, sorted by
+            weight, where the weight is the fraction of the
+            pixels closest to the color
+        """
+        pixels = pixels.astype(numpy.float32)
+        # a fixed seed gives the same colors for the same image
+        rng = numpy.random.default_rng(0)
 
-        random_file_name = super().get_random_name()
-        temp_image_filename = temp_file(self.service_name,
-                                        random_file_name) + ".jpg"
+        # k-means++ initialization
+        batch = pixels[rng.integers(0, len(pixels), self._KMEANS_BATCH_SIZE)]
+        centers = [batch[rng.integers(0, len(batch))]]
+        for _ in range(1, k):
+            distances = self.__squared_distances(
+                batch, numpy.array(centers)).min(axis=1)
+            total = distances.sum()
+            if total == 0:
+                break
+            centers.append(batch[rng.choice(len(batch), p=distances / total)])
+        centers = numpy.array(centers)
 
-        # Write the binary file to the disk
-        with open(temp_image_filename, "wb") as img_file:
-            img_file.write(image_obj)
+        # mini-batch updates, each center moving towards the mean of the
+        # samples assigned to it with a decreasing learning rate
+        counts = numpy.zeros(len(centers))
+        for _ in range(self._KMEANS_ITERATIONS):
+            batch = pixels[rng.integers(0, len(pixels),
+                                        self._KMEANS_BATCH_SIZE)]
+            labels = self.__squared_distances(batch, centers).argmin(axis=1)
+            batch_counts = numpy.bincount(labels, minlength=len(centers))
+            sums = numpy.zeros_like(centers)
+            numpy.add.at(sums, labels, batch)
+            counts += batch_counts
+            assigned = batch_counts > 0
+            centers[assigned] += (sums[assigned] - batch_counts[assigned, None]
+                                  * centers[assigned]) / counts[assigned, None]
+
+        labels = self.__squared_distances(pixels, centers).argmin(axis=1)
+        weights = numpy.bincount(labels, minlength=len(centers)) / len(pixels)
+        order = numpy.argsort(-weights)
+        return [(centers[i], float(weights[i])) for i in order if weights[i] > 0]
+
+    @staticmethod
+    def __squared_distances(points, centers) -> numpy.ndarray:
+        return ((points[:, numpy.newaxis, :] -
+                 centers[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+
+    def predict(self, req: dict) -> str:
+
+        # Convert base64 string to an image (decoded in memory)
+        myimg = self.sample(self.load_image(req))
+
+        colors = req.get("colors", 1)
+        if not isinstance(colors, int) or not 1 <= colors <= self.MAX_COLORS:
+            raise TorchException(
+                self.service_name,
+                f"Number of colors must be between 1 and {self.MAX_COLORS}")
 
-        # Read the image from disk
         try:
-            myimg = cv2.imread(temp_image_filename)
-            avg_color_per_row = numpy.average(myimg, axis=0)
-            avg_color = numpy.average(avg_color_per_row, axis=0)
-            # The format will be in BGR order (cv2 reads it that way)
-            # convert it to RGB
-            avg_color = avg_color.tolist()
-            avg_color.reverse()
-
-            # Now loop over the dataset to find the most similar color
-            # (considering k = 1), the datapoints are single
-
-            # temp vars for comparison of most similar data
-            min_score = sys.maxsize  # Best match
-            final_color = ''
-
-            # Read the data set
-            data_set_path = asset_file(self.service_name,
-                                       'detailed_color_dataset.txt')
-            with open(data_set_path) as data_set:
-                for line in data_set:
-                    cur_r, cur_g, cur_b, cur_color = line.split(',')
-                    # Calculate eucladien distance
-                    current_res = math.sqrt(
-                        (int(cur_r) - avg_color[0]) ** 2 +
-                        (int(cur_g) - avg_color[1]) ** 2 +
-                        (int(cur_b) - avg_color[2]) ** 2
-                    )
-                    if current_res < min_score:
-                        min_score = current_res
-                        final_color = cur_color
+            if colors == 1:
+                # Find the most similar color in the dataset to the
+                # average color (considering k = 1), the datapoints
+                # are single
+                avg_color = myimg.mean(axis=(0, 1))
+                return self.match(avg_color), 1
+
+            # Name the dominant colors, merging those with the same name
+            weights = {}
+            for color, weight in self.dominant_colors(
+                    myimg.reshape(-1, 3), colors):
+                name = self.match(color)
+                weights[name] = weights.get(name, 0) + weight
+            final_colors = [{"color": name, "weight": round(weight, 4)}
+                            for name, weight in sorted(
+                                weights.items(), key=lambda x: -x[1])]
 
         except Exception as err:
             # Log the error then throw the error
             log_e(self.service_name, str(err))
             raise err
 
-        # remove the image file
-        os.remove(temp_image_filename)
-        final_color = final_color.replace('\n', '')
-        return final_color, 1
+        return final_colors, 1
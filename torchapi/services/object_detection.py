@@ -4,35 +4,61 @@
 __author__ = "Emre Biçer"
 
 
-try:
-    from PIL import Image
-except ImportError:
-    import Image
 import numpy as np
-import os
-import tensorflow as tf
 from pattern.en import pluralize
 
 from .assets.object_detection.utils import label_map_util
 
+from .backends import OnnxBackend, SavedModelBackend
 from .base_services import Service
-from .common import asset_file, temp_file, base64_to_image_obj
+from .common import asset_file
 from ..exceptions import TorchException
 from ..logger import log_e, log_i
 
 
 class ObjectDetectionService(Service):
     """A service for detectin objects
+
+    ### Configuration
+    `backend`: the inference backend (see `backends`); `tensorflow` (the
+    default) runs the saved model, `onnx` runs the ONNX model `onnx_model`
+    (default `<MODEL_NAME>.onnx`) from the assets with ONNX Runtime.
+
+    `intra_op_threads`, `inter_op_threads`: the number of threads the `onnx`
+    session uses within and across operators.
+
+    ### Request options
+    `format`: `sentence` (the default) returns the detected objects
+    as an English sentence, e.g. "2 persons and 1 kite".
+    `structured` returns the detections as compact arrays (see
+    `filter_detections`):
+        {"boxes": [[ymin, xmin, ymax, xmax], ...],
+         "scores": [...], "classes": [...], "labels": [...]}
     """
 
     MODEL_NAME = 'ssd_mobilenet_v1_coco_2017_11_17'
     LABELS_FILE = 'mscoco_label_map.pbtxt'
     CLASSIFICATION_THRESHOLD = .5
 
-    def __init__(self):
+    # supported inference backends
+    BACKENDS = ("tensorflow", "onnx")
+
+    # supported response formats
+    FORMATS = ("sentence", "structured")
+
+    # decimals the numbers of structured responses are rounded to
+    STRUCTURED_DECIMALS = 4
+
+    def __init__(self, config=None):
         service_name = "object_detection"
 
-        super().__init__(service_name)
+        super().__init__(service_name, config)
+
+        self.backend_name = (self.config or {}).get("backend", "tensorflow")
+        if self.backend_name not in self.BACKENDS:
+            raise ValueError(
+                f"Unknown backend '{self.backend_name}', must be one of "
+                f"{', '.join(self.BACKENDS)}")
 
         # Declare the labels (category index)
         labels_path = asset_file(service_name, self.LABELS_FILE)
@@ -52,13 +78,21 @@ class ObjectDetectionService(Service):
     def load_model(self, model_name):
         """
         Loads the prediction model with the given name
-        from the disk and returns the model
+        from the disk and returns it as a `Backend` of the
+        configured type
         """
-        model_path = asset_file(self.service_name, model_name)
-        model = tf.saved_model.load(str(model_path))
-        model = model.signatures['serving_default']
+        config = self.config or {}
+        if self.backend_name == "onnx":
+            model_path = asset_file(
+                self.service_name,
+                config.get("onnx_model", model_name + ".onnx"))
+            return OnnxBackend(
+                model_path,
+                intra_op_threads=config.get("intra_op_threads", None),
+                inter_op_threads=config.get("inter_op_threads", None))
 
-        return model
+        model_path = asset_file(self.service_name, model_name)
+        return SavedModelBackend(model_path)
 
     def run_inference_for_single_image(self, model, image) -> dict:
         """
@@ -70,57 +104,95 @@ class ObjectDetectionService(Service):
                 'detection_boxes'
                 'num_detections'
         """
-        image = np.asarray(image)
-        # The input needs to be a tensor,
-        # convert it using `tf.convert_to_tensor`.
-        input_tensor = tf.convert_to_tensor(image)
-        # The model expects a batch of images, so add an
-        # axis with `tf.newaxis`.
-        input_tensor = input_tensor[tf.newaxis, ...]
-
-        # Run inference
-        output_dict = model(input_tensor)
+        return self.run_inference(model, [image])[0]
 
-        # All outputs are batches tensors.
-        # Convert to numpy arrays, and take index [0] to remove
-        # the batch dimension.
-        # We're only interested in the first num_detections.
-        num_detections = int(output_dict.pop('num_detections'))
-        output_dict = {key: value[0, :num_detections].numpy()
-                       for key, value in output_dict.items()}
-        output_dict['num_detections'] = num_detections
-
-        # detection_classes should be ints.
-        output_dict['detection_classes'] = \
-            output_dict['detection_classes'].astype(np.int64)
+    def run_inference(self, model, images: list) -> list:
+        """
+        Detect objects in all of the given image objects with a single
+        call to the model. All images must have the same shape.
+            Returns a list with one dictionary per image, in the
+            format of `run_inference_for_single_image`
+        """
+        images = np.stack([np.asarray(image) for image in images])
 
-        return output_dict
+        # Run inference
+        output_dict = model.run_dict(images)
+
+        # All outputs are batches arrays.
+        # Keep only the first num_detections of each image.
+        num_detections = output_dict.pop('num_detections')
+
+        results = []
+        for index, count in enumerate(num_detections):
+            count = int(count)
+            result = {key: value[index, :count]
+                      for key, value in output_dict.items()}
+            result['num_detections'] = count
+            # detection_classes should be ints.
+            result['detection_classes'] = \
+                result['detection_classes'].astype(np.int64)
+            results.append(result)
+
+        return results
+
+    def get_objects_with_frames(self, image_np) -> list:
+        """
+        Detect objects in the given RGB image array and return
+        a list of dictionaries with keys:
+            'object_name'
+            'frames'
+        """
+        detections = self.detect(image_np)
+        return [{'object_name': name, 'frames': box}
+                for name, box in zip(detections['names'],
+                                     detections['boxes'])]
 
-    def get_objects_with_frames(self, image_path: str) -> list:
-        image_np = np.array(Image.open(image_path))
+    def detect(self, image_np) -> dict:
+        """
+        Detect objects in the given RGB image array and return
+        the detections above the classification threshold
+        (see `filter_detections`)
+        """
         result_dict = self.\
                 run_inference_for_single_image(self.detection_model, image_np)
+        return self.filter_detections(result_dict)
 
-        # Filter the output by the threshold value
-        approved_indexes = []
-
-        for index, score in enumerate(result_dict['detection_scores']):
-            if score > self.CLASSIFICATION_THRESHOLD:
-                approved_indexes.append(index)
-
-        final_objects = []
-
-        # Get the approved classified objects
-        for index, class_id in enumerate(result_dict['detection_classes']):
-            if index in approved_indexes:
-                category = self.category_index.get(class_id)
-                final_objects.append({
-                    'object_name' : category['name'],
-                    'frames' : result_dict['detection_boxes'][index]
-                })
-
-        return final_objects
-    
+    def filter_detections(self, result_dict: dict) -> dict:
+        """
+        Keep the detections of a single inference result whose
+        score is above the classification threshold,
+            returns a dictionary with keys:
+                'boxes': array of shape (n, 4) of (ymin, xmin,
+                    ymax, xmax) relative to the image size
+                'scores': array of shape (n,)
+                'classes': array of shape (n,) of class ids
+                'names': list of the n class names
+                'counts': dictionary of the number of objects
+                    by class name, in order of first detection
+                'score': average score of the detections
+        """
+        mask = result_dict['detection_scores'] > self.CLASSIFICATION_THRESHOLD
+        scores = result_dict['detection_scores'][mask]
+        classes = result_dict['detection_classes'][mask]
+
+        # Count the objects of each class, keeping the order in
+        # which the classes are first detected
+        class_ids, first_indexes, counts = np.unique(
+            classes, return_index=True, return_counts=True)
+        order = np.argsort(first_indexes)
+        names = {int(class_id): self.category_index.get(int(class_id))['name']
+                 for class_id in class_ids}
+
+        return {
+            'boxes': result_dict['detection_boxes'][mask],
+            'scores': scores,
+            'classes': classes,
+            'names': [names[int(class_id)] for class_id in classes],
+            'counts': {names[int(class_ids[i])]: int(counts[i])
+                       for i in order},
+            'score': float(scores.sum(dtype=np.float64) / len(scores))
+                     if len(scores) else .0,
+        }
 
     def predict(self, req: dict) -> (str, float):
         """
@@ -133,97 +205,115 @@ class ObjectDetectionService(Service):
             e.g.
                 ('2 person,3 kite,', 'confidence': 0.810070)
         """
+        result = self.predict_batch([req])[0]
+        if isinstance(result, TorchException):
+            raise result
+        return result
 
-        # Convert base64 encoded data to image and save
-        # to the disk
-        try:
-            image_obj = base64_to_image_obj(req)
-        except TorchException as ex:
-            raise TorchException(msg=str(ex), origin=self.service_name)
-
-        random_file_name = super().get_random_name()
-        temp_image_filename = temp_file(self.service_name,
-                                        random_file_name) + ".jpg"
+    def predict_batch(self, reqs: list) -> list:
+        """
+            Runs detection on the images of all the given `reqs`.
+            Images of the same shape are passed to the model
+            together in a single call.
 
-        # Write the image to the disk
-        with open(temp_image_filename, "wb") as img_file:
-            img_file.write(image_obj)
+            See `Service.predict_batch` for the format of the
+            returned list.
+        """
+        results = [None] * len(reqs)
+        formats = [None] * len(reqs)
+
+        # Group the decoded images by their shape, since only
+        # images of the same shape can be stacked into a batch
+        groups = {}
+        for index, req in enumerate(reqs):
+            try:
+                formats[index] = self.__response_format(req)
+                image_np = self.__load_request_image(req)
+            except TorchException as exception:
+                results[index] = exception
+                continue
+            groups.setdefault(image_np.shape, []).append((index, image_np))
 
         try:
-            # Now read the image and detect objects in it
-            image_np = np.array(Image.open(temp_image_filename))
-            result_dict = self.\
-                run_inference_for_single_image(self.detection_model, image_np)
-
-            # {result_dict} includes keys:
-            #   'detection_scores'
-            #   'detection_classes'
-            #   'detection_boxes'
-            #   'num_detections'
-
-            # Filter the output by the threshold value
-            approved_indexes = []
-
-            avg_prediction_score = .0
-
-            for index, score in enumerate(result_dict['detection_scores']):
-                if score > self.CLASSIFICATION_THRESHOLD:
-                    approved_indexes.append(index)
-                    avg_prediction_score += score
-
-            approved_classifications = {}
-            # Get the approved classified objects
-            for index, class_id in enumerate(result_dict['detection_classes']):
-                if index in approved_indexes:
-                    category = self.category_index.get(class_id)
-                    if category['name'] in approved_classifications.keys():
-                        # Increment the count
-                        approved_classifications[category['name']] += 1
+            for group in groups.values():
+                indexes, images = zip(*group)
+                result_dicts = self.run_inference(self.detection_model,
+                                                  list(images))
+                for index, result_dict in zip(indexes, result_dicts):
+                    detections = self.filter_detections(result_dict)
+                    if formats[index] == 'structured':
+                        results[index] = self.__structure(detections)
                     else:
-                        approved_classifications[category['name']] = 1
-
-            # Prepare the result string
-            result = ''
-            for key in approved_classifications.keys():
-                if approved_classifications[key] > 1:
-                    # Convert to plural
-                    result += str(approved_classifications[key]) + ' ' + pluralize(key) + ','
-                else:
-                    # Already singular
-                    result += str(approved_classifications[key]) + ' ' + key + ','
-
-            if len(approved_indexes) != 0:
-                # Calculate the average prediction accuracy
-                avg_prediction_score = \
-                    avg_prediction_score / len(approved_indexes)
-
+                        results[index] = self.__describe(detections)
         except Exception as err:
-            # remove the image file
-            # os.remove(temp_image_filename)
-
             # Log the error then throw the error
             log_e(self.service_name, str(err))
             raise err
 
-        # Remove the image file
-        os.remove(temp_image_filename)
+        return results
 
-        if result == '':
+    def __response_format(self, req: dict) -> str:
+        """
+            Returns the response format requested by the given
+            `req`uest
+        """
+        response_format = req.get("format", "sentence")
+        if response_format not in self.FORMATS:
+            raise TorchException(
+                self.service_name,
+                f"Format must be one of {', '.join(self.FORMATS)}")
+        return response_format
+
+    def __load_request_image(self, req: dict):
+        """
+            Decodes the base64 image in the given `req`uest into
+            a numpy array
+        """
+        # Decode the base64 encoded image in memory
+        return self.load_image_obj(req).rgb
+
+    def __structure(self, detections: dict) -> (dict, float):
+        """
+            Builds the structured response and the average
+            confidence score from the detections of a single
+            image (see `filter_detections`)
+        """
+        decimals = self.STRUCTURED_DECIMALS
+        return {
+            'boxes': np.round(detections['boxes'].astype(np.float64),
+                              decimals).tolist(),
+            'scores': np.round(detections['scores'].astype(np.float64),
+                               decimals).tolist(),
+            'classes': detections['classes'].tolist(),
+            'labels': detections['names'],
+        }, detections['score']
+
+    def __describe(self, detections: dict) -> (str, float):
+        """
+            Builds the response sentence and the average
+            confidence score from the detections of a single
+            image (see `filter_detections`)
+        """
+        # Prepare the result string
+        objects = []
+        for name, count in detections['counts'].items():
+            if count > 1:
+                # Convert to plural
+                objects.append(str(count) + ' ' + pluralize(name))
+            else:
+                # Already singular
+                objects.append(str(count) + ' ' + name)
+
+        if not objects:
             result = 'nothing'
+        elif len(objects) == 1:
+            result = objects[0]
         else:
-            # Remove the last comma
-            result = result[:-1]
-            if ',' in result:
-                # Get the last , index
-                last_comma_index = result.rfind(',')
-                result = result[:last_comma_index] + " and " + result[last_comma_index+1:]
-
-        # Finally add a space after each comma
-        result = result.replace(',',', ')
+            result = ', '.join(objects[:-1]) + ' and ' + objects[-1]
 
         # Pattern library can't pluralize these keywords so do it manually here
         result = result.replace('buss', 'busses')
         result = result.replace('skis', 'pair of skis')
         result = result.replace('skiss', 'pair of skis')
 
-        return result, avg_prediction_score
+        return result, detections['score']
@@ -10,15 +10,11 @@ except ImportError:
     import Image
 import pytesseract
 
-import os
 import re
 from .base_services import Service
-from .common import asset_file, temp_file, base64_to_image_obj
-from ..exceptions import TorchException
 from ..logger import log_e
 
 import cv2
-import numpy as np
 
 class OcrService(Service):
     """A service for optical character recognition
@@ -28,20 +24,16 @@ class OcrService(Service):
         service_name = "ocr"
         super().__init__(service_name)
 
-    def pre_process_image(self, full_img_path:str):
+    def pre_process_image(self, img):
         """
-            Reads the image from the given path,
-            applies image processing techniques
+            Applies image processing techniques to the given
+            grayscale image array
                 - resizing with inter_area interpolation
                 - bilateral filter
                 - adaptive thresholding
-            Overrides the new image file to the 
-            previous path.
+            Returns the processed image array.
         """
         
-        # Read the image as 1 channel (grayscaled)
-        img = cv2.imread(full_img_path,cv2.CV_8UC1)
-        
         # Resize the image
         img = cv2.resize(img, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
         
@@ -51,9 +43,8 @@ class OcrService(Service):
         # Apply thresholding to stand out texts only
         cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2)        
         
-        # Write the image to the disk
-        cv2.imwrite(full_img_path,img)
-        
+        return img
+
 
     def predict(self, req: dict) -> str:
         
@@ -65,34 +56,23 @@ class OcrService(Service):
          but this is the function name that 'api.py' calls.
         """
 
-        # The base-64 string is converted into an image object but this object
-        # cannot be passed to Tesseract OCR engine directly. The object is first dumped into a
-        # temp file and then the filename is passed to Tesseract OCR engine.
-        try:
-            image_obj = base64_to_image_obj(req)
-        except TorchException as ex:
-            raise TorchException(msg=str(ex), origin=self.service_name)
+        # The base-64 string is decoded in memory as 1 channel (grayscaled)
+        img = self.load_image_obj(req).gray
 
-        random_file_name = super().get_random_name()
-        temp_image_filename = temp_file(self.service_name, random_file_name) + ".jpg"
-
-        with open(temp_image_filename, "wb") as img_file:
-            img_file.write(image_obj)
-            
         # Preprocess the image for better ocr
-        self.pre_process_image(temp_image_filename)
+        img = Image.fromarray(self.pre_process_image(img))
         
         try:
-            # Send the image name to the OCR engine
+            # Send the image to the OCR engine
             
             # Check if the language is specified
             lang = req.get("language", None)
             config = ("--oem 1")
 
             if lang:
-                result = pytesseract.image_to_string(Image.open(temp_image_filename), lang=lang, config=config)
+                result = pytesseract.image_to_string(img, lang=lang, config=config)
             else:
-                result = pytesseract.image_to_string(Image.open(temp_image_filename), config=config)
+                result = pytesseract.image_to_string(img, config=config)
 
             # Format the output, avoid unnecessarry chars
 
@@ -107,15 +87,10 @@ class OcrService(Service):
 
 
         except Exception as err:
-            # remove the image file
-            os.remove(temp_image_filename)
-            
             # Log the error then throw the error
             log_e(self.service_name,str(err))
             raise err
 
-        # remove the image file
-        os.remove(temp_image_filename)
         return result,1
     
     